@@ -1,27 +1,20 @@
 import argparse
-import re
+import importlib
+import gzip
 import logging
 import asyncio
-import subprocess
 import socket
+import os
+import time
 import yaml
 import discord
-import requests
-import pathlib
 
 from persist import DatabaseManager
-from tweets import TweetManager
-from reminders import ReminderManager
-from drlogger import DRLoggerManager
-from photos import PhotosManager
-from fun import FunManager
-from music import MusicManager
-from idea import IdeaManager
-
-from util import ValueRetainingRegexMatcher
-
-from google import genai
-from google.genai import types
+from summarize import SummaryManager
+from commands import CommandRegistry
+from ratelimit import RateLimiter
+from metrics import METRICS, MetricsExporter
+from gitversion import VersionManager
 
 # Parse the command line arguments
 parser = argparse.ArgumentParser(description='Run the TroupeTweets bot.')
@@ -66,6 +59,7 @@ if DRLOGGER_ENABLED:
 
 TWITTER_BEARER_TOKEN = config['twitter_bearer_token'] if TWITTER_ENABLED else None
 TWITTER_RELAY_MAP = config['twitter_relay_map'] if TWITTER_ENABLED else None
+TWEET_RETENTION_DAYS = config.get('tweet_cache_retention_days', 14)
 
 GOOGLE_CAL_CREDS = config['google_credentials'] if CALENDAR_ENABLED else None
 REMINDER_RELAY_MAP = config['reminder_relay_map'] if CALENDAR_ENABLED else None
@@ -76,19 +70,49 @@ DR_ACCOUNT_INFO = config['dr_account'] if DRLOGGER_ENABLED else None
 DRLOG_AUTHORIZED_USER_IDS = config['log_authorized_users'] if DRLOGGER_ENABLED else None
 DRLOG_UPLOAD_CHANNEL_ID = config['log_upload_channel'] if DRLOGGER_ENABLED else None
 DRLOG_FILENAME_PREFIX = config['log_filename_prefix'] if DRLOGGER_ENABLED else None
+DRLOG_ARCHIVE_PATH = config.get('log_archive_path', 'tt/archive')
+DRLOG_ARCHIVE_MAX_BYTES = config.get('log_archive_max_mb', 512) * 1024 * 1024
 
 NAUGHTY_CHANNEL_IDS = config['naughty_channels'] if FUN_ENABLED and 'naughty_channels' in config and config['naughty_channels'] else []
 
 MUSIC_TEXT_CHANNEL_ID = config['music_text_channel'] if MUSIC_ENABLED else None
 MUSIC_VOICE_CHANNEL_ID = config['music_voice_channel'] if MUSIC_ENABLED else None
+MUSIC_STREAMING = config.get('music_streaming', True)
+MUSIC_CACHE_PATH = config.get('music_cache_path', '.music')
+MUSIC_CACHE_MAX_BYTES = config.get('music_cache_max_mb', 1024) * 1024 * 1024
 
 GITHUB_TOKEN = config['github_token'] if IDEA_ENABLED else None
 MAINTAINER_ID = config['maintainer_id'] if IDEA_ENABLED else None
 
 GEMINI_KEY = config['gemini_key']
 
+RATE_LIMITS = config.get('rate_limits')
+
+METRICS_FILE_PATH = config.get('metrics_file_path')
+METRICS_PORT = config.get('metrics_port')
+# Who can see !stats. Defaults to the maintainer, if there is one.
+ADMIN_USER_IDS = config.get('admin_users') or ([config['maintainer_id']] if config.get('maintainer_id') else [])
+
 SIGNATURE_EMOJI = '<:wafflebot:780940516140515359>'
 
+# Feature modules are only imported if their feature is enabled, so an instance doesn't pay (in startup
+# time or memory) for dependencies it never uses. How long each import took is logged at startup.
+IMPORT_TIMES = {}
+
+
+def load_manager(module_name, class_name):
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    IMPORT_TIMES[module_name] = time.perf_counter() - start
+    return getattr(module, class_name)
+
+
+def log_import_report():
+    if not IMPORT_TIMES:
+        return
+    report = ', '.join([f'{name} {seconds:.2f}s' for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda _: -_[1])])
+    logging.info(f'Imported {len(IMPORT_TIMES)} feature modules in {sum(IMPORT_TIMES.values()):.2f}s ({report}).')
+
 
 HELP_TEXT = '''\
  BOT UTILITY FUNCTIONS
@@ -96,6 +120,7 @@ HELP_TEXT = '''\
 !ping                           Checks if online
 !help                           Displays this message
 !version [history]
+!stats                          How long things are taking, and what's failing (admins only)
 !idea <description>             Submit an idea for the bot's maintainer to implement.
 
      FUN FUNCTIONS
@@ -109,6 +134,7 @@ HELP_TEXT = '''\
 -----------------------
 !music play <url>               Play youtube url in the voice channel
 !music stop
+!music stats                    How many songs are saved, and how often they get reused
 
    PETPIC FUNCTIONS
 -----------------------
@@ -130,38 +156,81 @@ HELP_TEXT = '''\
 !log <start|stop>               Tells the troupe scribe to start or stop their note-taking (requires permission).'''
 
 
-# Command regex
-PING_REGEX = re.compile(r'!ping')
-CALENDAR_REGEX = re.compile(r'!events(?: (.+))')
-DRLOGGER_REGEX = re.compile(r'!log (start|stop)')
-NICE_REGEX = re.compile(r'!nice')
-JOKE_REGEX = re.compile(r'!joke')
-RIDDLE_REGEX = re.compile(r'!riddle')
-ROAST_REGEX = re.compile(r'!roast')
-HELP_REGEX = re.compile(r'!help')
-MUSIC_REGEX = re.compile(r'!music (play|stop|queue|skip|peek|list)(?: (.+youtube.+))?')
-PETPIC_REGEX = re.compile(r'!petpic (add|create|delete|list|random|remove|upload|wipe|share)(?: ([^\s\\]+))?(?: (.+))?')
-VERSION_REGEX = re.compile(r'!version(?: (.+))?')
-IDEA_REGEX = re.compile(r'!idea (.+)')
-SUMMARIZE_REGEX = re.compile(r'!summarize')
-
 class TroupeTweetBot(discord.Client):
     def __init__(self, **kwargs):
         self.db = DatabaseManager(DB_FILE_PATH)
-        self.tweets = TweetManager(self, self.db, TWITTER_BEARER_TOKEN, TWITTER_RELAY_MAP)
-        self.reminders = ReminderManager(self, GOOGLE_CAL_CREDS, REMINDER_RELAY_MAP)
-        self.drlogger = DRLoggerManager(self, DR_ACCOUNT_INFO, DRLOG_UPLOAD_CHANNEL_ID, DRLOG_FILENAME_PREFIX, GEMINI_KEY)
-        self.pics = PhotosManager(self, self.db, PETPIC_ROOT_PATH)
-        self.fun = FunManager(self, NAUGHTY_CHANNEL_IDS)
-        self.music = MusicManager(self, MUSIC_TEXT_CHANNEL_ID, MUSIC_VOICE_CHANNEL_ID)
-        self.idea = IdeaManager(self, GITHUB_TOKEN, MAINTAINER_ID)
+        # Logger instances don't set up the DB, so their summaries are only cached in memory
+        self.summarizer = SummaryManager(GEMINI_KEY, self.db if not DRLOGGER_ENABLED else None)
+        # Managers for disabled features are left as None, and their modules are never imported
+        self.tweets = None
+        self.reminders = None
+        self.drlogger = None
+        self.pics = None
+        self.fun = None
+        self.music = None
+        self.idea = None
+        if TWITTER_ENABLED:
+            TweetManager = load_manager('tweets', 'TweetManager')
+            self.tweets = TweetManager(self, self.db, TWITTER_BEARER_TOKEN, TWITTER_RELAY_MAP, TWEET_RETENTION_DAYS)
+        if CALENDAR_ENABLED:
+            ReminderManager = load_manager('reminders', 'ReminderManager')
+            self.reminders = ReminderManager(self, self.db, GOOGLE_CAL_CREDS, REMINDER_RELAY_MAP)
+        if DRLOGGER_ENABLED:
+            DRLoggerManager = load_manager('drlogger', 'DRLoggerManager')
+            self.drlogger = DRLoggerManager(self, DR_ACCOUNT_INFO, DRLOG_AUTHORIZED_USER_IDS, DRLOG_UPLOAD_CHANNEL_ID, DRLOG_FILENAME_PREFIX,
+                self.summarizer, DRLOG_ARCHIVE_PATH, DRLOG_ARCHIVE_MAX_BYTES)
+        if PETPIC_ENABLED:
+            PhotosManager = load_manager('photos', 'PhotosManager')
+            self.pics = PhotosManager(self, self.db, PETPIC_ROOT_PATH)
+        if FUN_ENABLED:
+            FunManager = load_manager('fun', 'FunManager')
+            self.fun = FunManager(self, NAUGHTY_CHANNEL_IDS)
+        if MUSIC_ENABLED:
+            MusicManager = load_manager('music', 'MusicManager')
+            self.music = MusicManager(self, self.db, MUSIC_TEXT_CHANNEL_ID, MUSIC_VOICE_CHANNEL_ID, MUSIC_CACHE_PATH, MUSIC_CACHE_MAX_BYTES,
+                MUSIC_STREAMING)
+        if IDEA_ENABLED:
+            IdeaManager = load_manager('idea', 'IdeaManager')
+            self.idea = IdeaManager(self, GITHUB_TOKEN, MAINTAINER_ID)
+        log_import_report()
+        self.version_info = VersionManager(os.path.dirname(os.path.abspath(__file__)))
+        self.metrics_exporter = MetricsExporter(METRICS, METRICS_FILE_PATH, METRICS_PORT)
         self.initialized = False
+        self.commands = self.register_commands()
         super().__init__(**kwargs)
 
 
+    def register_commands(self):
+        commands = CommandRegistry(RateLimiter(RATE_LIMITS))
+        # These work on every instance
+        commands.register('ping', self.ping)
+        commands.register('summarize', self.summarize)
+        commands.register('stats', self.stats)
+
+        # DRLOGGER instances only handle DRLOGGER commands, and everyone else leaves them alone
+        if DRLOGGER_ENABLED:
+            self.drlogger.register_commands(commands)
+            return commands
+
+        commands.register('version', self.version, r'(.+)?')
+        commands.register('help', self.help)
+        if CALENDAR_ENABLED:
+            self.reminders.register_commands(commands)
+        if FUN_ENABLED:
+            self.fun.register_commands(commands)
+        if PETPIC_ENABLED:
+            self.pics.register_commands(commands)
+        if MUSIC_ENABLED:
+            self.music.register_commands(commands)
+        if IDEA_ENABLED:
+            self.idea.register_commands(commands)
+        return commands
+
+
     async def on_ready(self):
         if not self.initialized:
             logging.info("TroupeBot initializing...")
+            await self.metrics_exporter.start()
             if not DRLOGGER_ENABLED:
                 await self.db.initialize()
             if TWITTER_ENABLED:
@@ -170,6 +239,15 @@ class TroupeTweetBot(discord.Client):
                 await self.reminders.initialize()
             if PETPIC_ENABLED:
                 await self.pics.initialize()
+            if MUSIC_ENABLED:
+                await self.music.initialize()
+            # Read the git history now, so the first !version doesn't wait on it
+            # A missing git (or .git) only breaks !version, it mustn't stop the bot from finishing startup
+            if not DRLOGGER_ENABLED:
+                try:
+                    await self.version_info.get_log(1)
+                except Exception:
+                    logging.exception('Failed to read the git history.')
             self.initialized = True
 
 
@@ -184,8 +262,10 @@ class TroupeTweetBot(discord.Client):
         
         # If the reaction was to a bot message, call the various handlers
         if reaction.message.author.id == self.user.id:
-            await self.pics.reaction_handler(user, reaction)
-            await self.idea.reaction_handler(user, reaction)
+            if self.pics:
+                await self.pics.reaction_handler(user, reaction)
+            if self.idea:
+                await self.idea.reaction_handler(user, reaction)
 
 
     async def on_message(self, message):
@@ -197,99 +277,62 @@ class TroupeTweetBot(discord.Client):
         if not message.content.startswith('!'):
             return
 
-        # Match against the right command, grab args, and go
-        m = ValueRetainingRegexMatcher(message.content)
-
-        # Handle ping separately, no matter the instance
-        if m.match(PING_REGEX):
-            return await message.channel.send(f'{message.author.mention} {socket.gethostname()} ({"non-" if not DRLOGGER_ENABLED else ""}logger)": pong!')
-
-        
-        if m.match(SUMMARIZE_REGEX):
-            logging.info("in sum")
-            if message.reference:
-                logging.info("in ref")
-                attachment = message.reference.resolved.attachments[0]
-                client = genai.Client(api_key=GEMINI_KEY)
-                gemini_payload = await attachment.read()
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-preview-05-20",
-                    contents=[gemini_payload, 'This is a log for a Tavern Troupe meeting. Summarize what happened in under 1900 characters, formatted for a discord message using a couple of cat-flavored emojis and perhaps a suggestion of cat puns. Finally, give a cute, overly enthusiastic shout-out to one of the members in attendance. Make the shout-out stress how that member is CLEARLY the most important member of the troupe, and  somehow include a reference to the content of the meeting.'])
-                return await message.channel.send(response.text)
-
-        # DRLOGGER instances only handle DRLOGGER commands
-        if DRLOGGER_ENABLED and m.match(DRLOGGER_REGEX):
-            cmd = m.group(1) if m.group(1) else None
-            if message.author.id not in DRLOG_AUTHORIZED_USER_IDS:
-                await message.channel.send('😾  You aren\'t allowed to do this! You\'ll have to ask the speakers to do this!')
-            elif cmd == 'start':
-                await self.drlogger.start(message.channel)
-            elif cmd == 'stop':
-                await self.drlogger.stop(message.channel)
-            else:
-                await message.channel.send('😾  You can start or stop logging with `!log <start|stop>`.')
-            
-            return
-        elif DRLOGGER_ENABLED:
-            return
-        
-        # non-DRLOGGER instances do nothing for DRLOGGER commands
-        if not DRLOGGER_ENABLED and m.match(DRLOGGER_REGEX):
-            return
-
-        # Process other commands
-        if m.match(CALENDAR_REGEX) and CALENDAR_ENABLED:
-            name = m.group(1) if m.group(1) else None
-            await self.reminders.get_upcoming_events(message.channel, calendar_name=name)
-        elif m.match(DRLOGGER_REGEX) and DRLOGGER_ENABLED:
-            await message.channel.send('😾  You can start or stop logging with `!log <start|stop>`.')
-        elif m.match(NICE_REGEX) and FUN_ENABLED:
-            await self.fun.compliment(message)
-        elif m.match(JOKE_REGEX) and FUN_ENABLED:
-            await self.fun.joke(message)
-        elif m.match(RIDDLE_REGEX) and FUN_ENABLED:
-            await self.fun.riddle(message)
-        elif m.match(ROAST_REGEX) and FUN_ENABLED:
-            await self.fun.roast(message)
-        elif m.match(PETPIC_REGEX) and PETPIC_ENABLED:
-            cmd = m.group(1)
-            album_name = m.group(2).lower() if m.group(2) else None
-            if cmd in ('add', 'upload') and album_name:
-                url = m.group(3) if m.group(3) else None
-                await self.pics.upload(message, album_name, url)
-            elif cmd == 'random':
-                await self.pics.fetch(message, album_name)
-            elif cmd == 'list':
-                all_albums = m.group(2).lower() == 'all' if m.group(2) else False
-                await self.pics.list_albums(message, all_albums=all_albums)
-            elif cmd == 'create' and album_name:
-                await self.pics.create_album(message, album_name)
-            elif cmd in ('delete', 'remove') and album_name:
-                await self.pics.delete_album(message, album_name)
-            elif cmd == 'wipe':
-                await self.pics.wipe(message)
-            elif cmd == 'share' and album_name:
-                await self.pics.share_album(message, album_name)
-            else:
-                await message.channel.send('😾  Not like this! Check `!help` for details on how to use `!petpic`.')
-        elif m.match(VERSION_REGEX):
-            num_commits = 5 if m.group(1) else 1
-            version_content = subprocess.check_output(['git', 'log', '--use-mailmap', f'-n{num_commits}'])
-            await message.channel.send("😸  💬   I'm the best version of myself, just like my dad taught me to be!" + 
-                "\n```" + str(version_content, 'utf-8') + "```")
-        elif m.match(MUSIC_REGEX) and MUSIC_ENABLED:
-            command = m.group(1)
-            url = m.group(2)
-            if command == 'play' and url:
-                await self.music.play(message, url)    
-            elif command == 'stop':
-                await self.music.stop(message)
-            elif command in ('list', 'queue', 'peek'):
-                await self.music.peek(message)
-        elif m.match(IDEA_REGEX):
-            await self.idea.submit(message, m.group(1))
-        elif m.match(HELP_REGEX):
-            await message.channel.send(f"😽  Here's what I know how to do (so far)!\n```{HELP_TEXT}```")
+        await self.commands.dispatch(message)
+
+
+    async def ping(self, message):
+        return await message.channel.send(f'{message.author.mention} {socket.gethostname()} ({"non-" if not DRLOGGER_ENABLED else ""}logger)": pong!')
+
+
+    async def summarize(self, message):
+        if message.reference:
+            attachment = message.reference.resolved.attachments[0]
+            payload = await attachment.read()
+            # Long logs are uploaded gzipped. Unzip them, so the summary (and its cache) works on the text.
+            if payload[:2] == b'\x1f\x8b':
+                try:
+                    payload = await asyncio.get_running_loop().run_in_executor(None, gzip.decompress, payload)
+                except (OSError, EOFError):
+                    logging.exception(f'Failed to unzip {attachment.filename}.')
+                    return await message.channel.send("😿  I couldn't open that log.")
+            summary = await self.summarizer.summarize_log(payload)
+            return await message.channel.send(summary)
+
+
+    async def version(self, message, history):
+        num_commits = 5 if history else 1
+        try:
+            version_content = await self.version_info.get_log(num_commits)
+        except Exception:
+            logging.exception('Failed to read the git history.')
+            return await message.channel.send("😿  I can't remember which version I am right now!")
+        await message.channel.send("😸  💬   I'm the best version of myself, just like my dad taught me to be!" + 
+            "\n```" + version_content + "```")
+
+
+    async def stats(self, message):
+        if message.author.id not in ADMIN_USER_IDS:
+            return await message.channel.send('😾  Only admins can see my stats!')
+
+        def table(title, rows):
+            if not rows:
+                return f'{title}: nothing yet\n'
+            lines = [f'{title}:'] + [f'  {str(name):<18} {count:>6}  p50 {p50:>5}s  p95 {p95:>5}s  {errors} errors'
+                for name, count, p50, p95, errors in rows[:10]]
+            return '\n'.join(lines) + '\n'
+
+        uptime = int(time.time() - METRICS.started)
+        content = f'Up for {uptime // 3600}h {uptime % 3600 // 60}m\n\n'
+        content += table('Commands', METRICS.summary('command_seconds', 'command')) + '\n'
+        content += table('External calls', METRICS.summary('external_call_seconds', 'service')) + '\n'
+        content += table('Database', METRICS.summary('db_query_seconds', 'method'))
+        # Every instance answers, so say which one this is
+        instance = f'{socket.gethostname()} ({"non-" if not DRLOGGER_ENABLED else ""}logger)'
+        await message.channel.send(f"😸  📊  Here's how I've been doing on {instance}!\n```{content}```")
+
+
+    async def help(self, message):
+        await message.channel.send(f"😽  Here's what I know how to do (so far)!\n```{HELP_TEXT}```")
 
 
 
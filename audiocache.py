@@ -0,0 +1,104 @@
+import os
+import logging
+
+from collections import OrderedDict
+
+# Songs are kept as opus, which is what discord wants anyway, so playing one is just a remux
+AUDIO_CACHE_EXTENSION = 'opus'
+
+
+class AudioCache():
+    '''
+    Downloaded songs, kept on disk by video id so playing one again needs no bandwidth.
+    Once the files add up to more than max_bytes, the least recently played songs are deleted first.
+    The index lives in the AUDIO_CACHE table, so the cache survives restarts.
+    '''
+    def __init__(self, db, root_path, max_bytes):
+        self.db = db
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        # video id --> size in bytes, least recently played first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # Since startup, how often a song was already here when it was wanted
+        self.hits = 0
+        self.misses = 0
+
+
+    def __contains__(self, video_id):
+        return video_id in self.entries and os.path.exists(self.path(video_id))
+
+
+    def path(self, video_id):
+        return os.path.join(self.root_path, f'{video_id}.{AUDIO_CACHE_EXTENSION}')
+
+
+    async def load(self):
+        os.makedirs(self.root_path, exist_ok=True)
+        missing = []
+        for video_id, filename, num_bytes, plays in await self.db.get_audio_cache():
+            if os.path.exists(os.path.join(self.root_path, filename)):
+                self.entries[video_id] = num_bytes
+                self.total_bytes += num_bytes
+            else:
+                missing.append(video_id)
+        if missing:
+            await self.db.delete_audio_cache_entries(missing)
+        logging.info(f'Audio cache has {len(self.entries)} songs ({self.total_bytes} bytes).')
+
+
+    async def lookup(self, video_id):
+        '''
+        Returns the path to a cached song and marks it as just played, or None if it isn't cached.
+        '''
+        if video_id not in self:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(video_id)
+        await self.db.touch_audio_cache_entry(video_id)
+        return self.path(video_id)
+
+
+    async def add(self, video_id, pinned=()):
+        '''
+        Adds a freshly downloaded song, then makes room for it. Songs in pinned are never evicted.
+        '''
+        num_bytes = os.path.getsize(self.path(video_id))
+        self.total_bytes += num_bytes - self.entries.get(video_id, 0)
+        self.entries[video_id] = num_bytes
+        self.entries.move_to_end(video_id)
+        await self.db.add_audio_cache_entry(video_id, os.path.basename(self.path(video_id)), num_bytes)
+        await self.evict(pinned)
+
+
+    async def evict(self, pinned=()):
+        evicted = []
+        for video_id in list(self.entries.keys()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if video_id in pinned:
+                continue
+            try:
+                os.remove(self.path(video_id))
+            except OSError:
+                pass
+            self.total_bytes -= self.entries.pop(video_id)
+            evicted.append(video_id)
+
+        if evicted:
+            await self.db.delete_audio_cache_entries(evicted)
+            logging.info(f'Evicted {len(evicted)} songs from the audio cache.')
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'songs': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,167 @@
+'''
+Offline benchmark for the DR log cleaner.
+
+Generates a synthetic DragonRealms-style raw log, then times cleaning it (throughput and peak memory) the
+original way - readlines() and re.match() against SPEECH_REGEX and EMOTE_REGEX - and with logcleaner.
+The outputs are compared byte for byte, along with the keep/drop decision for every line, so any change
+to the matcher can be proven equivalent to the regexes. Exits non-zero if they ever disagree.
+
+    python3 bench_logcleaner.py --lines 500000
+    python3 bench_logcleaner.py --lines 100000 --mix speech=5,emote=5,combat=60,roundtime=20,other=10
+'''
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from logcleaner import SPEECH_REGEX, EMOTE_REGEX, is_kept, clean_log, LiveLogCleaner
+
+NAMES = ['Bob', 'Ann', 'Fenlyn', 'Pistol', 'Waffle', 'Mirelle', 'Tarsk', 'Quill', 'Oona', 'Zeph']
+WORDS = ['tavern', 'troupe', 'song', 'meeting', 'cat', 'lute', 'Crossing', 'festival', 'ale', 'stage',
+    'dues', 'performance', 'riddle', 'juggling', 'ballad', 'costume', 'treasury', 'vote', 'minutes']
+SPEECH_VERBS = ['says', 'asks', 'exclaims', 'say', 'ask', 'exclaim']
+SPEECH_TEMPLATES = [
+    '{name} {verb}, "{words}{end}"',
+    'You {verb}, "{words}{end}"',
+    '{name} {verb} to {other}, "{words}{end}"',
+    '{name} (smiling) {verb}, "{words}{end}"',
+    '{name} quietly {verb}, "{words}{end}"',
+    '{name} {verb}, "{words}',
+]
+EMOTES = ['nods', 'smiles', 'grins', 'laughs', 'waves', 'bows', 'sighs', 'chuckles', 'clears her throat',
+    'gives a courteous nod', 'just arrived', 'curtsies', 'looks thoughtfully at the stage', 'shrugs',
+    'lets out a hearty cheer', 'rolls her eyes', 'studies the faces around the room', 'tail twitches',
+    'applauds', 'scratches his head', 'winks at you', 'hugs {other}', 'pats {other} on the back',
+    'whispers something to {other}', 'looks at {other} and applauds!', 'stares off into space', 'tails']
+EMOTE_ENDS = ['.', '!', ' at you.', ', smiling.', '', '?', 'x']
+COMBAT = [
+    'A rock troll swings a stone club at you.  You evade, barely stepping aside.',
+    '< You slice a broadsword at a rock troll.  A rock troll fails to evade.',
+    '[You\'re nimbly balanced and opponent is in a dominating position.]',
+    '{name} lunges a spear at a goblin.  The spear lands a solid hit to the goblin\'s chest.',
+    'A goblin closes to melee range on you!',
+    'The rock troll falls to the ground and lies still.',
+]
+ROUNDTIME = ['Roundtime: {n} sec.', '[Roundtime {n} sec.]', 'Roundtime complete.', 'RT: {n}']
+OTHER = [
+    '[The Raging Bull Inn, Common Room]',
+    'Also here: {name}, {other} and {name2}.',
+    'Obvious paths: north, east, out.',
+    '>',
+    '{name}\'s lute is slightly out of tune.',
+    'You also see a wooden table, a mug of ale and a tattered songbook.',
+    'The fire crackles softly in the hearth.',
+    '',
+]
+DEFAULT_MIX = 'speech=30,emote=25,combat=20,roundtime=10,other=15'
+
+
+def generate_line(kind, rng):
+    name, other, name2 = rng.sample(NAMES, 3)
+    if kind == 'speech':
+        words = ' '.join(rng.choices(WORDS, k=rng.randint(2, 14)))
+        return rng.choice(SPEECH_TEMPLATES).format(name=name, other=other, verb=rng.choice(SPEECH_VERBS),
+            words=words[0].upper() + words[1:], end=rng.choice('.!?.'))
+    if kind == 'emote':
+        possessive = "'s" if rng.random() < 0.1 else ''
+        return f'{name}{possessive} ' + rng.choice(EMOTES).format(other=other) + rng.choice(EMOTE_ENDS)
+    if kind == 'combat':
+        return rng.choice(COMBAT).format(name=name)
+    if kind == 'roundtime':
+        return rng.choice(ROUNDTIME).format(n=rng.randint(1, 9))
+    return rng.choice(OTHER).format(name=name, other=other, name2=name2)
+
+
+def generate_log(path, num_lines, mix, seed):
+    rng = random.Random(seed)
+    kinds = list(mix.keys())
+    weights = list(mix.values())
+    with open(path, 'w') as f:
+        for kind in rng.choices(kinds, weights=weights, k=num_lines):
+            f.write(generate_line(kind, rng) + '\n')
+
+
+def reference_clean(raw_path, cleaned_path):
+    # How the log used to be cleaned, kept here as the ground truth
+    with open(raw_path) as f:
+        lines = f.readlines()
+    includes = [_.strip() for _ in lines if re.match(SPEECH_REGEX, _) or re.match(EMOTE_REGEX, _)]
+    includes = includes[1:-1]
+    with open(cleaned_path, 'w') as f:
+        f.write('\r\n'.join(includes))
+    return len(includes)
+
+
+def live_clean(raw_path, cleaned_path):
+    with LiveLogCleaner(cleaned_path) as cleaner, open(raw_path) as raw:
+        for line in raw:
+            cleaner.feed(line)
+    return cleaner.lines_written
+
+
+def measure(fn, *args):
+    # Time a clean run first, then run it again under tracemalloc for the peak
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def parse_mix(mix):
+    return {kind: float(weight) for kind, weight in [_.split('=') for _ in mix.split(',')]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DR log cleaner against synthetic logs.')
+    parser.add_argument('--lines', type=int, default=200000, help='How many raw lines to generate.')
+    parser.add_argument('--mix', type=str, default=DEFAULT_MIX, help='Relative weights of each kind of line.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, for repeatable logs.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        raw_path = os.path.join(temp_dir, 'bench.raw')
+        generate_log(raw_path, args.lines, parse_mix(args.mix), args.seed)
+        raw_bytes = os.path.getsize(raw_path)
+        print(f'Generated {args.lines} lines ({raw_bytes / 1024 / 1024:.1f} MB), mix {args.mix}')
+
+        outputs = {}
+        for name, fn in (('reference', reference_clean), ('clean_log', clean_log), ('live', live_clean)):
+            cleaned_path = os.path.join(temp_dir, f'{name}.txt')
+            elapsed, peak = measure(fn, raw_path, cleaned_path)
+            with open(cleaned_path, 'rb') as f:
+                outputs[name] = f.read()
+            print(f'  {name:<10} {elapsed:7.3f}s  {args.lines / elapsed:12,.0f} lines/s  '
+                f'{raw_bytes / 1024 / 1024 / elapsed:7.1f} MB/s  peak {peak / 1024 / 1024:7.2f} MB')
+
+        # Golden checks. Every line has to get the same decision, and the outputs have to be identical.
+        mismatches = 0
+        with open(raw_path) as f:
+            for line in f:
+                expected = bool(re.match(SPEECH_REGEX, line) or re.match(EMOTE_REGEX, line))
+                if is_kept(line) != expected:
+                    if mismatches < 10:
+                        print(f'  MISMATCH (expected {expected}): {line!r}')
+                    mismatches += 1
+        for name in ('clean_log', 'live'):
+            if outputs[name] != outputs['reference']:
+                print(f'  MISMATCH: {name} output differs from the reference output')
+                mismatches += 1
+
+        if mismatches:
+            print(f'FAILED: {mismatches} mismatches')
+            sys.exit(1)
+        kept = len(outputs['reference'].split(b'\r\n')) if outputs['reference'] else 0
+        print(f'OK: all outputs match the reference ({kept} lines kept)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import re
+
+from metrics import METRICS
+
+COMMAND_PREFIX = '!'
+
+
+class Command():
+    def __init__(self, name, handler, args_regex=None, usage=None, subcommand_aliases=None):
+        self.name = name
+        self.handler = handler
+        # Matched against whatever follows the command name. Its groups are passed to the handler.
+        self.args_regex = re.compile(args_regex) if isinstance(args_regex, str) else args_regex
+        # Sent back if the arguments don't match. If there isn't one, bad arguments are ignored.
+        self.usage = usage
+        # Other names the handler accepts for a subcommand (add --> upload), so they share its limits
+        self.subcommand_aliases = subcommand_aliases or {}
+
+
+    def subcommand(self, args):
+        '''
+        The first argument (upload in !petpic upload ...), under its main name. None if there isn't one.
+        '''
+        if not args or not isinstance(args[0], str):
+            return None
+        return self.subcommand_aliases.get(args[0], args[0])
+
+
+class CommandRegistry():
+    '''
+    Maps the first word of a message (!music, !petpic...) straight to the command that handles it.
+    Each manager registers its own commands, and only the matched command's arguments are ever parsed.
+    If there's a rate limiter, every command has to get past it before it runs.
+    '''
+    def __init__(self, limiter=None):
+        # command name (without the !) --> Command
+        self.commands = {}
+        self.limiter = limiter
+
+
+    def register(self, name, handler, args_regex=None, usage=None, aliases=(), subcommand_aliases=None):
+        command = Command(name, handler, args_regex, usage, subcommand_aliases)
+        for key in (name, *aliases):
+            if key in self.commands:
+                raise ValueError(f'The command {COMMAND_PREFIX}{key} is already registered.')
+            self.commands[key] = command
+
+
+    def lookup(self, content):
+        '''
+        Returns the Command a message is for and the rest of the message, or (None, None).
+        '''
+        if not content.startswith(COMMAND_PREFIX):
+            return None, None
+        parts = content[len(COMMAND_PREFIX):].split(None, 1)
+        if not parts:
+            return None, None
+        return self.commands.get(parts[0]), parts[1] if len(parts) > 1 else ''
+
+
+    async def dispatch(self, message):
+        '''
+        Runs the command a message is for. Returns whether there was one.
+        '''
+        command, rest = self.lookup(message.content)
+        if command is None:
+            return False
+
+        args = ()
+        if command.args_regex:
+            m = command.args_regex.match(rest)
+            if not m:
+                if command.usage:
+                    await message.channel.send(command.usage)
+                return True
+            args = m.groups()
+
+        # Limits can be set on a whole command, or just one of its subcommands (petpic upload)
+        limit_name = self.limiter.limit_name(command.name, command.subcommand(args)) if self.limiter else None
+        if self.limiter and not await self.limiter.allow(message, limit_name):
+            METRICS.increment('commands_rate_limited_total', command=command.name)
+            return True
+        semaphore = self.limiter.semaphores.get(limit_name) if self.limiter else None
+        with METRICS.timer('command_seconds', command=command.name):
+            if semaphore is None:
+                await command.handler(message, *args)
+            else:
+                # Heavy commands wait their turn for one of a few slots shared by everyone
+                async with semaphore:
+                    await command.handler(message, *args)
+        return True
@@ -1,37 +1,42 @@
 import time
 import re
 import os
-import tempfile
-import shutil
-import time
+import gzip
 import logging
 import asyncio
-from telnetlib import Telnet
 
-import libtmux
 import discord
-from google import genai
-from google.genai import types
-
-# Some patterns stolen wholesale from http://drservice.info/static/logcleaner.htm
-SPEECH_REGEX = r'^(You|\w*(\s\(.*\))?)(\s\w*)?\s(say|ask|exclaim)s?(\sto)?(\s\w*(\s\(.*\))?)?, ".*[.!?]"$'
-EMOTE_REGEX = r'^\w*(\'s)? (nods?|gives a courteous|gives a slight|smiles?|frowns?|ponders?|hails?|leans?|\
-clears?|coughs?|chuckles?|laughs?|grins?|tail|just nudged|nudges?|gulps?|stands?|lies?|sits?|gazes?|smirks?|\
-shakes?|casually observes?|trills?|begins chortling|winks?|hugs?|scratch(es)?|squints?|just arrived|blinks?|\
-scowls?|arch|raises?|snaps?|taps?|joins?|flash(es)?|snickers?|waves?|rubs?|stares?|fix(es)?|giggles?|squirms?|\
-shrugs?|twitch(es)?|inhales?|looks? thoughtfully|angles?|knits?|shivers?|takes?|licks?|shifts?|strokes?|applauds?|\
-jots?|folds?|pats?|glances?|gnaws?|winces?|wrinkles?|hiccups?|gets? an odd expression|motions?|fidgets?|ears droop|\
-bows?|curts(y|ies)?|furrows?|praises?|mutters?|slowly empt(y|ies)?|clucks?|shudders?|body jerks|briefly drops?|\
-offers?|beams?|the tip of|rearranges?|touch(es)?|search(es)?|ears?|cocks?|grumbles?|peers?|stud(y|ies) the faces|\
-tightly laces|brotherly hug|dusts (him|her)self|rolls? (your|his|her) eyes|kiss(es)?|paces?|howls?|perks? up|\
-writes? something|opens?|closes?|grunts?|praises?|guzzles?|whispers something to|looks at [a-zA-Z]+ and applauds!|\
-lets out a loud "Huzzah!"|lets? out a hearty cheer|babbles|slaps?|nibbles?|gasps?|covers?|glares?|cringes?|\
-pointedly ignores|sighs?)([.!?, ].*)?$'
+
+from logcleaner import LiveLogCleaner
+from logarchive import LogArchive
+
+# Where the EAccess login server lives, and where the game is if the login server doesn't say
+EACCESS_HOST = 'access.simutronics.com'
+EACCESS_PORT = 7900
+DEFAULT_GAME_HOST = 'prime.dr.game.play.net'
+DEFAULT_GAME_PORT = 4901
+# How long (seconds) to wait on any single reply from the login server, or for the game to start talking
+EACCESS_TIMEOUT = 5
+GAME_STARTUP_TIMEOUT = 30
+# How often (seconds) the scribe does something, so the game doesn't disconnect it for being idle
+KEEPALIVE_INTERVAL = 180
+
+# Where logs are written while recording
+LOG_TEMP_PATH = 'tt/temp'
+# Cleaned logs up to this size (bytes) are uploaded as plain text, so they can be read right in Discord.
+# Anything bigger goes up gzipped, as long as that fits under Discord's upload limit.
+PLAIN_UPLOAD_LIMIT = 1024 * 1024
+DISCORD_UPLOAD_LIMIT = 8 * 1024 * 1024
+
+# Telnet option negotiation (IAC ...) that the game may mix into its output
+TELNET_COMMAND_REGEX = re.compile(rb'\xff[\xfb-\xfe].|\xff[\xf0-\xfa]', re.DOTALL)
 
 
 class DRLoggerManager():
-    def __init__(self, bot, credentials, upload_channel_id, log_prefix, gemini_key):
+    def __init__(self, bot, credentials, authorized_user_ids, upload_channel_id, log_prefix, summarizer, archive_path,
+            archive_max_bytes, eaccess_host=EACCESS_HOST, eaccess_port=EACCESS_PORT):
         self.bot = bot
+        self.authorized_user_ids = set(authorized_user_ids or [])
         self.username = credentials['username'] if credentials else None
         self.password = credentials['password'] if credentials else None
         self.character = credentials['character'] if credentials else None
@@ -39,7 +44,27 @@ class DRLoggerManager():
         self.log_prefix = log_prefix
         self.running = False
         self.startup_lock = asyncio.Lock()
-        self.gemini_key = gemini_key
+        self.summarizer = summarizer
+        self.archive = LogArchive(archive_path, archive_max_bytes)
+        self.eaccess_host = eaccess_host
+        self.eaccess_port = eaccess_port
+
+        # The open game connection, and an event that's set when it's time to leave
+        self.writer = None
+        self.stop_event = asyncio.Event()
+
+
+    def register_commands(self, registry):
+        registry.register('log', self.log_command, r'(start|stop)')
+
+
+    async def log_command(self, message, cmd):
+        if message.author.id not in self.authorized_user_ids:
+            await message.channel.send('😾  You aren\'t allowed to do this! You\'ll have to ask the speakers to do this!')
+        elif cmd == 'start':
+            await self.start(message.channel)
+        elif cmd == 'stop':
+            await self.stop(message.channel)
 
 
     async def start(self, channel):
@@ -54,70 +79,81 @@ class DRLoggerManager():
                         break
                     
                     logging.info('DRLoggerManager is awaiting a clean exit...')
-                    asyncio.sleep(15)
+                    await asyncio.sleep(15)
                     
                 if self.running:
                     logging.info('DRLoggerManager could not cleanly exit... Killing with fire...')
                     await self.kill()
-            elif libtmux.Server(socket_name='dr-tmux-server'):
-                logging.info('Found a lingering TMUX server, maybe from a prior run. Killing it.')
-                await self.kill()
 
-            # Runs this in the thread pool because it's a blocking IO task due to telnet connectivity
-            loop = asyncio.get_running_loop()
-            auth_key = None
+            login = None
             for i in range(3):
                 try:
-                    auth_key = await loop.run_in_executor(None, self.authenticate, self.username, self.password, self.character)
+                    login = await self.authenticate(self.username, self.password, self.character)
                 except Exception as e:
                     logging.exception(f'Something went wrong during auth, will try {str(2-i)} more times...')
-                    asyncio.sleep(3)
+                    await asyncio.sleep(3)
 
-                if auth_key:
+                if login:
                     break
             
-            if not auth_key:
+            if not login:
                 return await channel.send("😿  💬   Uhoh... Something went wrong, and the scribe didn't wake up...")
             await channel.send("😸  💬   I'll tell the troupe scribe that a meeting is starting!")
             
-            raw_path = await loop.run_in_executor(None, self.connect_and_run, auth_key)
-            cleaned_path = os.path.splitext(raw_path)[0] + '.txt'
+            log_name = f"{self.log_prefix}_{time.strftime('%Y%m%d-%H%M%S')}"
+            raw_path = os.path.join(LOG_TEMP_PATH, log_name + '.raw.gz')
+            cleaned_path = os.path.join(LOG_TEMP_PATH, log_name + '.txt')
+            compressed_path = cleaned_path + '.gz'
 
-            logging.info(f'Cleaning log file {raw_path}...')
-            lines = []
-            with open(raw_path) as f:
-                lines = f.readlines()
-            
-            includes = [_.strip() for _ in lines if re.match(SPEECH_REGEX, _) or re.match(EMOTE_REGEX, _)]
-            # work around to some input oddities with tintin++, cut out first and last line
-            includes = includes[1:-1]
-            with open(cleaned_path, 'w') as f:
-                f.write('\r\n'.join(includes))
+            # Clean (and compress) the log as it's recorded, so it's ready the moment the meeting ends
+            with LiveLogCleaner(cleaned_path, compressed_path) as cleaner:
+                try:
+                    await self.connect_and_run(login, raw_path, cleaner)
+                except Exception as e:
+                    logging.exception('Something went wrong while recording the log, uploading what there is...')
+
+            # If the game never sent anything, there's nothing to summarize, upload or keep
+            if cleaner.lines_read == 0:
+                for path in (raw_path, cleaned_path, compressed_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                return await channel.send("😿  💬   Uhoh... Something went wrong, and the scribe didn't wake up...")
+
+            top_speakers = ', '.join([f'{name} ({count})' for name, count in cleaner.speakers.most_common(5)])
+            logging.info(f'Kept {cleaner.lines_written} of {cleaner.lines_read} lines in {cleaned_path}. Top speakers: {top_speakers}')
 
-            
-            gemini_payload = ""
             with open(cleaned_path, 'rb') as f:
-                gemini_payload = f.read()
-                f.seek(0)
-                client = genai.Client(api_key=self.gemini_key)
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-preview-05-20",
-                    contents=[gemini_payload, 'This is a log for a Tavern Troupe meeting. Summarize what happened in under 1900 characters, formatted for a discord message using a couple of cat-flavored emojis and perhaps a suggestion of cat puns. Finally, give a cute, overly enthusiastic shout-out to one of the members in attendance. Make the shout-out stress how that member is CLEARLY the most important member of the troupe, and  somehow include a reference to the content of the meeting.'])
-                logging.info(f'Uploading {cleaned_path} to channel {self.upload_channel_id}...')
-                send_file = discord.File(f, filename=f.name, spoiler=False)
+                summary = await self.summarizer.summarize_log(f.read())
+
+            upload_path = cleaned_path if os.path.getsize(cleaned_path) <= PLAIN_UPLOAD_LIMIT else compressed_path
+            if os.path.getsize(upload_path) <= DISCORD_UPLOAD_LIMIT:
+                logging.info(f'Uploading {upload_path} to channel {self.upload_channel_id}...')
+                send_file = discord.File(upload_path, filename=os.path.basename(upload_path), spoiler=False)
                 await channel.send("😸  ✉️   Meeting adjourned! Here's the log!", file=send_file)
-                await channel.send(response.text)
-            logging.info('File upload completed.')
+                logging.info('File upload completed.')
+            else:
+                logging.warning(f'{upload_path} is too big to upload, it will only be archived.')
+                await channel.send("😸  ✉️   Meeting adjourned! The log was too long to upload, but I've kept it safe.")
+            await channel.send(summary)
+
+            # The plain text copy was only needed for the upload, the compressed logs get kept
+            loop = asyncio.get_running_loop()
+            os.remove(cleaned_path)
+            await loop.run_in_executor(None, lambda: self.archive.add(log_name, [raw_path, compressed_path],
+                lines=cleaner.lines_written, speakers=dict(cleaner.speakers.most_common())))
 
 
     async def stop(self, channel):
         if self.running:
             await channel.send("😸  💬   I'll tell the troupe scribe that the meeting is over!")
             self.running = False
+            self.stop_event.set()
             logging.info('DRLoggerManager attempting to cleanly stop...')
 
 
-    def authenticate(self, username, password, character):
+    async def authenticate(self, username, password, character):
         # This implements the EACCESS protocol. I think... Read on if you're into that stuff.
         # https://warlockclient.fandom.com/wiki/EAccess_Protocol
         #
@@ -125,128 +161,139 @@ class DRLoggerManager():
         # https://github.com/dylb0t/dr-tin/blob/master/bin/drconn.pl
         #
         # Allegedly, this might be deprecated in time. We'll cross that bridge when we get there.
-        logging.info('Authenticating and sending login instruction to access.simutronics.com...')
+        #
+        # Returns (key, game host, game port), or None if the character isn't on the account.
+        logging.info(f'Authenticating and sending login instruction to {self.eaccess_host}...')
         username = username.encode('ascii')
         password = password.encode('ascii')
         character = character.encode('ascii')
 
-        remote = "access.simutronics.com"
-        port = 7900
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.eaccess_host, self.eaccess_port), EACCESS_TIMEOUT)
 
-        auth_key = None
-        with Telnet(remote, port) as conn:
-            conn.write(b'K\n')
-            key = conn.read_until(b'\n', timeout=5).strip()
+        async def send(line):
+            writer.write(line + b'\n')
+            await writer.drain()
+            return (await asyncio.wait_for(reader.readline(), EACCESS_TIMEOUT)).strip()
+
+        try:
+            key = await send(b'K')
             newpass = bytearray(len(password))
             for i in range(len(password)):
                 c = key[i] ^ password[i]
                 c = c ^ 0x40 if key[i] >= ord(b'a') else c
                 c = c | 0x80 if c < ord(b' ') else c
                 newpass[i] = c
-            conn.write(b'A\t' + username + b'\t' + newpass + b'\n')
-            key = conn.read_until(b'\n', timeout=5).strip()
+            key = await send(b'A\t' + username + b'\t' + newpass)
             p = re.compile(r'^.+?KEY\t([a-fA-F0-9]+)\t.*$')
             m = p.match(key.decode('ascii'))
             key = m.group(1)
 
-            conn.write(b'G\tDR\n')
-            conn.read_until(b'\n', timeout=5).strip()
-            conn.write(b'C\n')
-            output = conn.read_until(b'\n', timeout=5).strip()
+            await send(b'G\tDR')
+            output = await send(b'C')
             lines = output.decode('ascii').split('\t')
 
             pairs = zip(lines[5::2], lines[6::2])
             character_map = {p[0].encode('ascii'): p[1].encode('ascii') for p in pairs}
 
-            found = False
             char_token = None
             for k in character_map:
                 if character_map[k].lower() == character.lower():
-                    found = True
                     char_token = k
                     break
 
-            if not found:
+            if not char_token:
                 return None
 
-            conn.write(b'L\t' + char_token + b'\tPLAY\n')
-            conn.read_until(b'\n', timeout=5).strip()
+            # The launch reply says where to connect (GAMEHOST=..., GAMEPORT=..., KEY=...)
+            launch = await send(b'L\t' + char_token + b'\tPLAY')
+            fields = dict([_.split('=', 1) for _ in launch.decode('ascii').split('\t') if '=' in _])
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
         logging.info('Authentication complete.')
-        return key
+        return fields.get('KEY', key), fields.get('GAMEHOST', DEFAULT_GAME_HOST), int(fields.get('GAMEPORT', DEFAULT_GAME_PORT))
+
 
+    async def connect_and_run(self, login, log_path, cleaner):
+        # Logs into the game, and writes everything it says to the raw log (and the cleaner)
+        # until someone tells the scribe to stop, or the game hangs up.
+        key, host, port = login
+        self.stop_event.clear()
 
-    def connect_and_run(self, key):
+        logging.info(f'Connecting to DragonRealms at {host}:{port}...')
+        reader, self.writer = await asyncio.open_connection(host, port)
+        # Only running once there's a connection, so a failed one never leaves a meeting behind to stop
         self.running = True
-        
-        logging.info('Creating launch file for tintin++...')
-        with open('dr.tin', 'w') as tt_file:
-            tt_file.write(f'#ses dr prime.dr.game.play.net 4901;{key};;')
-            tt_file.write('''
-#nop Global Variables
-#var \{CURRENT_RT\} \{0\};
-
-#nop Global Roundtime Tracker
-#action \{%?Roundtime: %1 sec%+\} \{ #var CURRENT_RT %1; \
-#var rtn @roundtime\{\}; #unvar $rtn; \
-#delay \{roundtime\} \{#showme <118>Roundtime complete.; \} \{%1\} \}
-#action \{%?Roundtime %1 sec%+\} \{ #var CURRENT_RT %1; \
-#var rtn @roundtime\{\};#unvar $rtn; \
-#delay \{roundtime\} \{#showme <118>Roundtime complete.;\} \{%1\} \}
-
-#read tt/highlight.conf
-#read tt/function.conf
-#nop #read tt/prompt.conf''')
-
-        logging.info('Creating clean tmux server "dr-tmux-server"... ')
-        server = libtmux.Server(socket_name='dr-tmux-server')
-        session = server.new_session('dr-window')
-        window = session.select_window(0)
-        pane = window.select_pane(0)
-        logging.info('Starting up DragonRealms via tintin++ client and re-attaching...')
-
-        log_name = f"{self.log_prefix}_{time.strftime('%Y%m%d-%H%M%S')}.raw"
-        
-        log_path = os.path.join('tt/temp', log_name)
-        pane.send_keys('tt++ dr.tin', enter=True)
-        time.sleep(30)
-        
-        pane.send_keys('#config log plain', enter=True)
-        pane.send_keys(f'#log overwrite {log_path}', enter=True)
-        logging.info(f'tintin++ is now logging to {log_path}')
-        
-        pane.send_keys('inhale', enter=True)
-
-        seconds_recording = 0
-        while self.running:
-            # pulse every 3 minutes
-            if seconds_recording % 180 == 0:
-                pane.send_keys('scrib', enter=True)
-            time.sleep(5)
-            seconds_recording += 5
-
-        # Upload to discord channel
-        channel = discord.utils.get(self.bot.get_all_channels(), id=int(self.upload_channel_id))
-
-        pane.send_keys('nod', enter=True)
-        pane.send_keys('wave', enter=True)
-        pane.send_keys('exit')
-
-        logging.info('DR Cleanly exited. Killing tmux...')
-        server.kill_server()
-        self.running = False
+        record_task = None
+        try:
+            self.writer.write(key.encode('ascii') + b'\n\n')
+            await self.writer.drain()
+
+            connected = asyncio.Event()
+            record_task = asyncio.create_task(self._record(reader, log_path, cleaner, connected))
+            # Wait for the game to start talking, rather than for a fixed amount of time
+            connected_task = asyncio.create_task(connected.wait())
+            await asyncio.wait([record_task, connected_task], timeout=GAME_STARTUP_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+            connected_task.cancel()
+            logging.info(f'Now logging to {log_path}')
+            if not record_task.done():
+                await self._send('inhale')
+
+            stop_task = asyncio.create_task(self.stop_event.wait())
+            while self.running and not record_task.done():
+                # pulse every 3 minutes
+                await self._send('scrib')
+                await asyncio.wait([record_task, stop_task], timeout=KEEPALIVE_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+            stop_task.cancel()
+
+            if not record_task.done():
+                await self._send('nod')
+                await self._send('wave')
+                await self._send('exit')
+                # Give the game a moment to say goodbye and hang up
+                await asyncio.wait([record_task], timeout=EACCESS_TIMEOUT)
+            logging.info('DR Cleanly exited.')
+        finally:
+            await self.kill()
+            if record_task:
+                record_task.cancel()
+                try:
+                    await record_task
+                except asyncio.CancelledError:
+                    pass
         return log_path
 
 
-    async def kill(self):
-        # Ensure that there's no existing server running
-        try:
-            server = libtmux.Server(socket_name='dr-tmux-server')
-            logging.info('Found tmux server, killing...')
-            server.kill_server()
-            logging.info('Killed tmux server.')
-        except:
-            pass
+    async def _record(self, reader, log_path, cleaner, connected):
+        with gzip.open(log_path, 'wt') as raw:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    logging.info('The game closed the connection.')
+                    return
+                connected.set()
+
+                # Drop telnet negotiation and any leading prompts, leaving just the text
+                line = TELNET_COMMAND_REGEX.sub(b'', data).decode('utf-8', errors='replace').replace('\r', '').lstrip('>')
+                raw.write(line)
+                cleaner.feed(line)
 
-        self.running = False
 
+    async def _send(self, command):
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(command.encode('ascii') + b'\n')
+            await self.writer.drain()
 
+
+    async def kill(self):
+        # Hang up on the game, if connected
+        if self.writer:
+            try:
+                self.writer.close()
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+
+        self.running = False
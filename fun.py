@@ -10,6 +10,13 @@ class FunManager():
         self.naughty_channels = set(naughty_channels)
 
 
+    def register_commands(self, registry):
+        registry.register('nice', self.compliment)
+        registry.register('joke', self.joke)
+        registry.register('riddle', self.riddle)
+        registry.register('roast', self.roast)
+
+
     async def compliment(self, message):
         from app import SIGNATURE_EMOJI
         compliment = requests.get('https://complimentr.com/api').json()['compliment']
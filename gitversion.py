@@ -0,0 +1,78 @@
+import os
+import asyncio
+import logging
+import subprocess
+
+
+class VersionManager():
+    '''
+    Serves !version from memory. The commit HEAD points at is read straight out of .git, which is just a
+    couple of small file reads, and git itself is only run (in a thread) the first time a given HEAD is asked about.
+    '''
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.git_dir = self._find_git_dir(repo_path)
+        # (HEAD commit, number of commits) --> git log output
+        self.logs = {}
+
+
+    @staticmethod
+    def _find_git_dir(repo_path):
+        git_dir = os.path.join(repo_path, '.git')
+        # In a worktree or submodule, .git is a file pointing at the real directory
+        if os.path.isfile(git_dir):
+            with open(git_dir) as f:
+                line = f.read().strip()
+            if line.startswith('gitdir:'):
+                git_dir = os.path.join(repo_path, line[len('gitdir:'):].strip())
+        return git_dir
+
+
+    def _read_ref(self, ref):
+        try:
+            with open(os.path.join(self.git_dir, ref)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+
+        # Refs that haven't changed in a while only live in packed-refs
+        try:
+            with open(os.path.join(self.git_dir, 'packed-refs')) as f:
+                for line in f:
+                    if line.startswith(('#', '^')):
+                        continue
+                    sha, _, name = line.strip().partition(' ')
+                    if name == ref:
+                        return sha
+        except FileNotFoundError:
+            pass
+        return None
+
+
+    def head(self):
+        '''
+        The commit HEAD points at, or None if it can't be worked out.
+        '''
+        head = self._read_ref('HEAD')
+        # Follow symbolic refs (ref: refs/heads/master), unless HEAD is detached
+        while head and head.startswith('ref:'):
+            head = self._read_ref(head[len('ref:'):].strip())
+        return head
+
+
+    def _git_log(self, num_commits):
+        return subprocess.check_output(['git', 'log', '--use-mailmap', f'-n{num_commits}'], cwd=self.repo_path).decode('utf-8')
+
+
+    async def get_log(self, num_commits=1):
+        head = self.head()
+        key = (head, num_commits)
+        if head is None or key not in self.logs:
+            logging.info(f'Reading git history for {head}...')
+            log = await asyncio.get_event_loop().run_in_executor(None, self._git_log, num_commits)
+            if head is None:
+                return log
+            # Only the current HEAD is worth remembering
+            self.logs = {_: self.logs[_] for _ in self.logs if _[0] == head}
+            self.logs[key] = log
+        return self.logs[key]
@@ -1,6 +1,7 @@
 import discord
 import github
 
+from metrics import METRICS
 
 
 class IdeaManager():
@@ -11,6 +12,10 @@ class IdeaManager():
         self.pending_cache = {}
 
 
+    def register_commands(self, registry):
+        registry.register('idea', self.submit, r'(.+)')
+
+
     async def reaction_handler(self, user, reaction):
         '''
         Hook that the main bot application calls on a reaction to see
@@ -23,14 +28,15 @@ class IdeaManager():
         # If the reaction is from the owner, and a valid option, interpet it. Otherwise, purge.
         if user.id == self.maintainer_id and reaction.count > 1:
             if reaction.emoji == '🆗':
-                client = github.Github(self.github_token)
-                repo = client.get_repo("eartsar/TavernTroupeDiscordBot")
-                issue = repo.create_issue(
-                    title=self.pending_cache[reaction.message]['title'],
-                    body=self.pending_cache[reaction.message]['body'],
-                    assignee="eartsar",
-                    labels=[repo.get_label("idea")]
-                )
+                with METRICS.timer('external_call_seconds', service='github'):
+                    client = github.Github(self.github_token)
+                    repo = client.get_repo("eartsar/TavernTroupeDiscordBot")
+                    issue = repo.create_issue(
+                        title=self.pending_cache[reaction.message]['title'],
+                        body=self.pending_cache[reaction.message]['body'],
+                        assignee="eartsar",
+                        labels=[repo.get_label("idea")]
+                    )
 
                 await reaction.message.reply('Idea accepted.')
                 return await self.pending_cache[reaction.message]['request'].reply('Your idea was accepted by the maintainer.')
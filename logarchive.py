@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import shutil
+import logging
+
+INDEX_FILENAME = 'index.json'
+
+
+class LogArchive():
+    '''
+    A directory of past meeting logs, capped at max_bytes. Once it's over the cap, the oldest meetings
+    are deleted first. index.json lists the meetings by date, along with their files and line counts.
+
+    NOT ASYNC - THESE METHODS TOUCH THE DISK, RUN THEM IN A THREAD
+    '''
+    def __init__(self, root_path, max_bytes):
+        self.root_path = root_path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root_path, INDEX_FILENAME)
+
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+
+    def _save_index(self, meetings):
+        # Write and swap, so a crash never leaves a half-written index behind
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(meetings, f, indent=2)
+        os.replace(temp_path, self.index_path)
+
+
+    def add(self, name, paths, **details):
+        '''
+        Moves the given files into the archive as one meeting, then rotates out old meetings if needed.
+        Anything passed as details (line counts, speakers...) is saved in the index entry.
+        '''
+        os.makedirs(self.root_path, exist_ok=True)
+        files = []
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            archived_path = os.path.join(self.root_path, os.path.basename(path))
+            shutil.move(path, archived_path)
+            files.append({'name': os.path.basename(path), 'bytes': os.path.getsize(archived_path)})
+
+        meetings = self.load_index()
+        meetings.append({'name': name, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'files': files, **details})
+        meetings = self._rotate(meetings)
+        self._save_index(meetings)
+        logging.info(f'Archived meeting {name} ({sum([_["bytes"] for _ in files])} bytes) to {self.root_path}.')
+
+
+    def _rotate(self, meetings):
+        total = sum([_['bytes'] for meeting in meetings for _ in meeting['files']])
+        # The newest meeting always stays, even on its own it's over the cap
+        while total > self.max_bytes and len(meetings) > 1:
+            oldest = meetings.pop(0)
+            for archived in oldest['files']:
+                try:
+                    os.remove(os.path.join(self.root_path, archived['name']))
+                except OSError:
+                    pass
+                total -= archived['bytes']
+            logging.info(f'Rotated meeting {oldest["name"]} out of the log archive.')
+        return meetings
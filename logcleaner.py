@@ -0,0 +1,216 @@
+import re
+import gzip
+from collections import Counter
+
+# Some patterns stolen wholesale from http://drservice.info/static/logcleaner.htm
+SPEECH_REGEX = r'^(You|\w*(\s\(.*\))?)(\s\w*)?\s(say|ask|exclaim)s?(\sto)?(\s\w*(\s\(.*\))?)?, ".*[.!?]"$'
+EMOTE_REGEX = r'^\w*(\'s)? (nods?|gives a courteous|gives a slight|smiles?|frowns?|ponders?|hails?|leans?|\
+clears?|coughs?|chuckles?|laughs?|grins?|tail|just nudged|nudges?|gulps?|stands?|lies?|sits?|gazes?|smirks?|\
+shakes?|casually observes?|trills?|begins chortling|winks?|hugs?|scratch(es)?|squints?|just arrived|blinks?|\
+scowls?|arch|raises?|snaps?|taps?|joins?|flash(es)?|snickers?|waves?|rubs?|stares?|fix(es)?|giggles?|squirms?|\
+shrugs?|twitch(es)?|inhales?|looks? thoughtfully|angles?|knits?|shivers?|takes?|licks?|shifts?|strokes?|applauds?|\
+jots?|folds?|pats?|glances?|gnaws?|winces?|wrinkles?|hiccups?|gets? an odd expression|motions?|fidgets?|ears droop|\
+bows?|curts(y|ies)?|furrows?|praises?|mutters?|slowly empt(y|ies)?|clucks?|shudders?|body jerks|briefly drops?|\
+offers?|beams?|the tip of|rearranges?|touch(es)?|search(es)?|ears?|cocks?|grumbles?|peers?|stud(y|ies) the faces|\
+tightly laces|brotherly hug|dusts (him|her)self|rolls? (your|his|her) eyes|kiss(es)?|paces?|howls?|perks? up|\
+writes? something|opens?|closes?|grunts?|praises?|guzzles?|whispers something to|looks at [a-zA-Z]+ and applauds!|\
+lets out a loud "Huzzah!"|lets? out a hearty cheer|babbles|slaps?|nibbles?|gasps?|covers?|glares?|cringes?|\
+pointedly ignores|sighs?)([.!?, ].*)?$'
+
+
+# Both patterns are anchored, so matching is just a yes/no question per line. Rather than running each raw
+# line through both (EMOTE_REGEX is one big alternation that gets tried branch by branch), the matcher below
+# uses cheap checks to rule out almost everything first, and only then runs a small piece of the pattern.
+#
+# Speech always contains ', "' and ends in a closing quote, so anything else can skip SPEECH_REGEX entirely.
+#
+# Emotes are a name (optionally possessive) and a space, followed by one of the verb alternatives. Since a
+# name can't contain an apostrophe or space, where the verb starts is fixed. The verb alternatives are bucketed
+# by their first few literal characters, so at most a handful of them are ever tried against a line.
+_EMOTE_NAME_PREFIX = r'^\w*(\'s)? ('
+_EMOTE_VERB_SUFFIX = r')([.!?, ].*)?$'
+_REGEX_METACHARACTERS = '()[]{}|?*+.^$'
+
+
+def _split_alternatives(pattern):
+    # Splits a pattern on its top-level |, leaving nested groups and escapes alone
+    alternatives = []
+    depth = 0
+    current = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            current += pattern[i:i + 2]
+            i += 2
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            alternatives.append(current)
+            current = ''
+            i += 1
+            continue
+        current += c
+        i += 1
+    alternatives.append(current)
+    return alternatives
+
+
+def _literal_prefix(alternative):
+    # The characters every match of the alternative has to start with
+    prefix = ''
+    i = 0
+    while i < len(alternative):
+        c = alternative[i]
+        if c == '\\' and i + 1 < len(alternative) and not alternative[i + 1].isalnum():
+            literal = alternative[i + 1]
+            i += 2
+        elif c in _REGEX_METACHARACTERS or c == '\\':
+            break
+        else:
+            literal = c
+            i += 1
+        # A quantifier after this character means it may not be there at all
+        if i < len(alternative) and alternative[i] in '?*{':
+            break
+        prefix += literal
+    return prefix
+
+
+def _build_emote_matcher():
+    assert EMOTE_REGEX.startswith(_EMOTE_NAME_PREFIX) and EMOTE_REGEX.endswith(_EMOTE_VERB_SUFFIX)
+    verbs = _split_alternatives(EMOTE_REGEX[len(_EMOTE_NAME_PREFIX):-len(_EMOTE_VERB_SUFFIX)])
+    prefixes = [_literal_prefix(verb) for verb in verbs]
+    key_length = min(len(prefix) for prefix in prefixes)
+    assert key_length > 0
+
+    buckets = {}
+    for verb, prefix in zip(verbs, prefixes):
+        buckets.setdefault(prefix[:key_length], []).append(verb)
+    compiled = {key: re.compile('(' + '|'.join(group) + _EMOTE_VERB_SUFFIX) for key, group in buckets.items()}
+    return re.compile(r"\w*(?:'s)? "), compiled, key_length
+
+
+SPEECH_MATCHER = re.compile(SPEECH_REGEX)
+EMOTE_NAME_MATCHER, EMOTE_VERB_MATCHERS, EMOTE_KEY_LENGTH = _build_emote_matcher()
+
+
+def is_speech(line):
+    if ', "' not in line or not (line.endswith('"') or line.endswith('"\n')):
+        return False
+    return SPEECH_MATCHER.match(line) is not None
+
+
+def is_emote(line):
+    name = EMOTE_NAME_MATCHER.match(line)
+    if not name:
+        return False
+    start = name.end()
+    verb_matcher = EMOTE_VERB_MATCHERS.get(line[start:start + EMOTE_KEY_LENGTH])
+    return verb_matcher is not None and verb_matcher.match(line, start) is not None
+
+
+def is_kept(line):
+    '''
+    Whether a raw log line is worth keeping. Same answer as matching SPEECH_REGEX or EMOTE_REGEX, only faster.
+    '''
+    return is_speech(line) or is_emote(line)
+
+
+def clean_lines(lines):
+    '''
+    Generator over the kept lines of a raw log, stripped. The first and last kept lines
+    are dropped, to work around some input oddities with tintin++.
+    '''
+    kept = (line.strip() for line in lines if is_kept(line))
+    # Skip the first line, and always hold one back so the last one never gets out
+    next(kept, None)
+    previous = next(kept, None)
+    for line in kept:
+        yield previous
+        previous = line
+
+
+def speaker_of(line):
+    # Whoever is talking or emoting is the first word of the line, minus any possessive
+    speaker = line.split(' ', 1)[0]
+    return speaker[:-2] if speaker.endswith("'s") else speaker
+
+
+class LiveLogCleaner():
+    '''
+    Cleans a log while it's still being recorded. Raw lines are fed in as they arrive, and kept lines are written
+    to the cleaned file straight away, with the same first/last line trimming as clean_lines(). Keeps running
+    counts of lines read and written, and how many lines each speaker has.
+
+    If compressed_path is given, a gzipped copy of the cleaned log is written alongside it as it goes.
+    '''
+    def __init__(self, cleaned_path, compressed_path=None):
+        self.cleaned_path = cleaned_path
+        self.cleaned = open(cleaned_path, 'w')
+        self.compressed_path = compressed_path
+        self.compressed = gzip.open(compressed_path, 'wt') if compressed_path else None
+        self.lines_read = 0
+        self.lines_written = 0
+        self.speakers = Counter()
+        self.seen_first = False
+        self.held = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def feed(self, line):
+        self.lines_read += 1
+        if not is_kept(line):
+            return
+
+        line = line.strip()
+        # Skip the first line, and always hold one back so the last one never gets out
+        if not self.seen_first:
+            self.seen_first = True
+            return
+        if self.held is not None:
+            self._write(self.held)
+        self.held = line
+
+
+    def _write(self, line):
+        # The separator only goes into the files, speaker_of() needs the bare line
+        output = ('\r\n' if self.lines_written else '') + line
+        self.cleaned.write(output)
+        self.cleaned.flush()
+        if self.compressed:
+            self.compressed.write(output)
+        self.lines_written += 1
+        self.speakers[speaker_of(line)] += 1
+
+
+    def close(self):
+        # Whatever is still held back is the last line, which gets dropped
+        self.held = None
+        self.cleaned.close()
+        if self.compressed:
+            self.compressed.close()
+
+
+def clean_log(raw_path, cleaned_path):
+    '''
+    Streams a raw log into a cleaned one, line by line. Returns the number of lines written.
+
+    NOT AN ASYNC METHOD - RUN IT IN A THREAD
+    '''
+    written = 0
+    with open(raw_path) as raw, open(cleaned_path, 'w') as cleaned:
+        for line in clean_lines(raw):
+            cleaned.write(('\r\n' if written else '') + line)
+            written += 1
+    return written
@@ -0,0 +1,211 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+
+# Upper bounds (seconds) of the latency histogram buckets. Anything slower lands in +Inf.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# How often (seconds) the metrics file is rewritten, if there is one
+METRICS_FILE_INTERVAL = 60
+METRICS_PREFIX = 'troupebot_'
+
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def quantile(self, q):
+        '''
+        Roughly the qth quantile: the upper bound of the bucket it falls in.
+        '''
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class Metrics():
+    '''
+    In-process counters and latency histograms, labelled like Prometheus metrics, e.g.
+        METRICS.increment('command_errors_total', command='petpic')
+        with METRICS.timer('external_call_seconds', service='twitter'):
+            ...
+    Everything here runs on the event loop, so there's no locking.
+    '''
+    def __init__(self):
+        # (name, ((label, value), ...)) --> Histogram or count
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(seconds)
+
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        '''
+        Times the block into the name histogram. If it raises, name's error counter goes up too.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(name.replace('_seconds', '') + '_errors_total', **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def render(self):
+        '''
+        Everything in the Prometheus text exposition format.
+        '''
+        def format_labels(labels, extra=()):
+            pairs = [f'{k}="{str(v)}"' for k, v in labels + tuple(extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines = []
+        for name in sorted({_[0] for _ in self.counters}):
+            lines.append(f'# TYPE {METRICS_PREFIX}{name} counter')
+            for (_, labels), value in sorted([_ for _ in self.counters.items() if _[0][0] == name]):
+                lines.append(f'{METRICS_PREFIX}{name}{format_labels(labels)} {value}')
+
+        for name in sorted({_[0] for _ in self.histograms}):
+            lines.append(f'# TYPE {METRICS_PREFIX}{name} histogram')
+            for (_, labels), histogram in sorted([_ for _ in self.histograms.items() if _[0][0] == name], key=lambda _: _[0]):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{METRICS_PREFIX}{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{METRICS_PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{METRICS_PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+
+        lines.append(f'# TYPE {METRICS_PREFIX}uptime_seconds gauge')
+        lines.append(f'{METRICS_PREFIX}uptime_seconds {time.time() - self.started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+    def summary(self, name, label):
+        '''
+        Returns (label value, count, p50, p95, errors) for each series of the name histogram, busiest first.
+        '''
+        errors_name = name.replace('_seconds', '') + '_errors_total'
+        rows = []
+        for (histogram_name, labels), histogram in self.histograms.items():
+            if histogram_name != name:
+                continue
+            value = dict(labels).get(label)
+            errors = self.counters.get((errors_name, labels), 0)
+            rows.append((value, histogram.count, histogram.quantile(0.5), histogram.quantile(0.95), errors))
+        return sorted(rows, key=lambda _: -_[1])
+
+
+# Shared by the whole bot, so anything can record into it without having it passed around
+METRICS = Metrics()
+
+
+def timed_methods(name, label='method'):
+    '''
+    Class decorator that times every public coroutine method into the name histogram, labelled by method name.
+    '''
+    def decorator(cls):
+        for attr, fn in list(vars(cls).items()):
+            if attr.startswith('_') or not asyncio.iscoroutinefunction(fn):
+                continue
+
+            def wrap(fn, attr):
+                @functools.wraps(fn)
+                async def wrapper(*args, **kwargs):
+                    with METRICS.timer(name, **{label: attr}):
+                        return await fn(*args, **kwargs)
+                return wrapper
+            setattr(cls, attr, wrap(fn, attr))
+        return cls
+    return decorator
+
+
+class MetricsExporter():
+    '''
+    Makes the metrics available to Prometheus (or anything else): on a local HTTP endpoint at /metrics,
+    in a file that's rewritten every minute, or both.
+    '''
+    def __init__(self, metrics, file_path=None, port=None, host='127.0.0.1'):
+        self.metrics = metrics
+        self.file_path = file_path
+        self.port = port
+        self.host = host
+        self.tasks = []
+        self.runner = None
+
+
+    async def start(self):
+        if self.file_path:
+            self.tasks.append(asyncio.create_task(self.write_file_forever()))
+        if self.port:
+            # aiohttp comes with discord.py, but is only loaded if the endpoint is turned on
+            from aiohttp import web
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle_metrics)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logging.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+        return web.Response(text=self.metrics.render(), content_type='text/plain')
+
+
+    def write_file(self):
+        # Write and swap, so a scraper never reads a half-written file
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.metrics.render())
+        os.replace(temp_path, self.file_path)
+
+
+    async def write_file_forever(self):
+        while True:
+            try:
+                self.write_file()
+            except OSError:
+                logging.exception(f'Failed to write metrics to {self.file_path}.')
+            await asyncio.sleep(METRICS_FILE_INTERVAL)
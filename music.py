@@ -1,124 +1,388 @@
 import discord
 import youtube_dl
 import asyncio
-import shutil
+import logging
+import time
+import re
 import os
 
+from collections import deque
+from itertools import islice
+
+from util import TTLCache
+from audiocache import AudioCache
+from metrics import METRICS
+
 DISALLOW_MESSAGE = 'these commands are only usable in #music-channel'
-SONG_FILENAME = '.song.mp4'
+NO_VOICE_CHANNEL_MESSAGE = 'join a voice channel first, and I will follow you there'
+# How many tracks past the one playing are downloaded ahead of time
+PREFETCH_COUNT = 2
+# Only the audio is ever fetched, whether it's streamed or downloaded
+AUDIO_FORMAT = 'bestaudio/best'
+# Streams are piped straight into FFmpeg, which reconnects if YouTube drops the connection part way through
+STREAM_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+STREAM_OPTIONS = '-vn'
+# A stream that ends this quickly (seconds) is assumed to have failed, and the track is downloaded instead
+STREAM_FAILURE_WINDOW = 3
+# Track info is remembered for a while, so queueing a song again doesn't look it up again.
+# Stream URLs expire after a few hours, so this needs to stay well under that.
+TRACK_INFO_CACHE_TTL = 1800
+TRACK_INFO_CACHE_SIZE = 128
+
+# !music <command> [url]
+MUSIC_ARGS_REGEX = r'(play|stop|queue|skip|peek|list|stats)(?: (.+youtube.+))?'
+VIDEO_ID_REGEX = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})')
+
+
+def video_id(url):
+    '''
+    The youtube video id in a url, so different links to the same video are recognized as the same.
+    Falls back to the url itself if there isn't one.
+    '''
+    match = VIDEO_ID_REGEX.search(url)
+    return match.group(1) if match else url.strip()
 
 
 class QueueItem():
-    def __init__(self, message, url, data):
+    def __init__(self, message, url, data, path, voice_channel):
         self.message = message
         self.url = url
         self.data = data
         self.title = data['title']
+        self.video_id = data['id']
+        self.path = path
+        self.voice_channel = voice_channel
+        # Set once the track is being fetched into the cache. Its result is whether that worked.
+        self.download = None
+        # Set if streaming didn't work out, so the track is played from a download instead
+        self.stream_failed = not data.get('url')
 
 
-class MusicManager():
-    def __init__(self, bot, music_text_channel_id, music_voice_channel_id):
-        self.bot = bot
-        self.music_text_channel_id = music_text_channel_id
-        self.music_voice_channel_id = music_voice_channel_id
-        self.queue = []
+class GuildPlayer():
+    '''
+    Everything about the music in one server: its queue, its voice connection, and what's being prefetched.
+    One task per player plays the queue from front to back, and it's the only thing that ever starts a song
+    or takes one off the queue. Audio callbacks just wake it up, so they can't race each other or a !music stop.
+    '''
+    def __init__(self, manager, guild):
+        self.manager = manager
+        self.guild = guild
+        self.queue = deque()
+        self.voice = None
+        self.task = None
+
+
+    @property
+    def playing(self):
+        return self.task is not None and not self.task.done()
 
 
-    def _download(self, url):
+    def enqueue(self, item):
+        self.queue.append(item)
+        self.prefetch()
+        if not self.playing:
+            self.task = asyncio.create_task(self.run())
+
+
+    def prefetch(self):
+        # Start fetching the playing track and the next few, if they aren't already.
+        # Even streamed tracks are fetched, so they're cached for the next time they're played.
+        for item in islice(self.queue, PREFETCH_COUNT + 1):
+            if item.download is None:
+                item.download = self.manager.download(item)
+
+
+    async def run(self):
         try:
-            os.remove(SONG_FILENAME)
-        except:
-            pass
+            # Anything queued while it was disconnecting was told it's in the queue, so it goes around again.
+            # The queue is checked last thing before returning, so enqueue() either sees this task or starts a new one.
+            while self.queue:
+                await self.play_queue()
+                await self.disconnect()
+        except asyncio.CancelledError:
+            await self.disconnect()
+            raise
 
-        ydl_opts = {'format': 'mp4', 'outtmpl': SONG_FILENAME, 'nooverwrites': False, 'audioquality': '128K'}
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+
+    async def play_queue(self):
+        try:
+            while self.queue:
+                item = self.queue[0]
+                await self.play(item)
+                self.queue.popleft()
+                self.prefetch()
+                # Songs held back from eviction while they were queued can go now
+                await self.manager.cache.evict(pinned=self.manager.pinned())
+        except Exception:
+            logging.exception(f'Music player for {self.guild.name} crashed.')
+            self.queue.clear()
 
 
-    async def play(self, message, url, called_internally=False):
-        if message.channel.id != self.music_text_channel_id:
-            return await message.channel.send(f'{message.author.mention}, {DISALLOW_MESSAGE}')
+    async def play(self, item):
+        # Anything already cached plays from disk. Otherwise it's streamed while it downloads.
+        streaming = self.manager.stream and not item.stream_failed and item.video_id not in self.manager.cache
+        if not streaming:
+            # Shielded, since other queue entries for the same song share this download
+            if not await asyncio.shield(item.download):
+                return await item.message.channel.send(f"😿  I couldn't play *{item.title}*, skipping it.")
 
-        data = None
-        with youtube_dl.YoutubeDL({}) as ydl:
-            data = ydl.extract_info(url, download=False)
-            await self.bot.change_presence(
-                activity=discord.Activity(
-                    type=discord.ActivityType.listening,
-                    name=data['title'],
-                    url=url,
-                    small_image_url=data['thumbnail']
-                )
+        await self.connect(item.voice_channel)
+        await self.manager.bot.change_presence(
+            activity=discord.Activity(
+                type=discord.ActivityType.listening,
+                name=item.title,
+                url=item.url,
+                small_image_url=item.data['thumbnail']
             )
+        )
+        await item.message.reply(f"😸 🎵  **Now playing:** *{item.title}*  🎵")
 
-        # If this was called by a normal user, add the song to the queue, and bail if we're currently playing
-        if not called_internally:
-            self.queue.append(QueueItem(message, url, data))
-            if len(self.queue) > 1:
-                return await message.channel.send("Song added to the queue.")
+        error = await self.play_source(item, streaming)
+        # A stream that errored or died right away gets one more try, from a download
+        if streaming and error is not None:
+            logging.warning(f'Streaming {item.url} failed ({error}), downloading it instead.')
+            item.stream_failed = True
+            if not await asyncio.shield(item.download):
+                return await item.message.channel.send(f"😿  I couldn't play *{item.title}*, skipping it.")
+            await self.play_source(item, False)
 
-        await asyncio.get_event_loop().run_in_executor(None, self._download, url)
 
-        channel = discord.utils.find(lambda channel: channel.id == self.music_voice_channel_id, message.guild.voice_channels)
+    async def play_source(self, item, streaming):
+        '''
+        Plays one song through to the end. Returns None if it played properly, or what went wrong.
+        '''
+        if streaming:
+            source = discord.FFmpegOpusAudio(item.data['url'], bitrate=128,
+                before_options=STREAM_BEFORE_OPTIONS, options=STREAM_OPTIONS)
+        else:
+            source = discord.FFmpegOpusAudio(item.path, codec='copy')
+
+        # The callback comes from the audio thread. It only ever touches this one song's event.
+        loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+        errors = []
+        def finish_playing(error):
+            errors.append(error)
+            loop.call_soon_threadsafe(finished.set)
+
+        started = time.monotonic()
+        self.voice.play(source, after=finish_playing)
+        await finished.wait()
+        if errors[0] is not None:
+            return errors[0]
+        if streaming and time.monotonic() - started < STREAM_FAILURE_WINDOW:
+            return 'ended right away'
+        return None
+
+
+    async def connect(self, channel):
+        if self.voice and self.voice.is_connected():
+            if self.voice.channel != channel:
+                await self.voice.move_to(channel)
+            return
         try:
-            await channel.connect()
+            self.voice = await channel.connect()
         except discord.errors.ClientException:
-            pass
-        
+            # Already connected here, from before this player knew about it
+            self.voice = discord.utils.get(self.manager.bot.voice_clients, guild=self.guild)
 
-        def finish_playing(error):
-            # It's possible that we interrupted playing, and that this hook still gets called
-            if self.queue:
-                self.queue.pop(0)
-            
+
+    async def disconnect(self):
+        if self.voice:
+            await self.voice.disconnect()
+            self.voice = None
+        # Presence is shared by every server, so it's only cleared once nothing is playing anywhere
+        if not any([_.playing and _ is not self for _ in self.manager.players.values()]):
+            await self.manager.bot.change_presence(status=discord.Status.online, activity=None)
+
+
+    async def stop(self):
+        self.queue.clear()
+        if self.playing:
+            self.task.cancel()
             try:
-                os.remove(SONG_FILENAME)
-            except:
+                await self.task
+            except asyncio.CancelledError:
                 pass
+        else:
+            await self.disconnect()
 
-            if self.queue:
-                coro = self.play(self.queue[0].message, self.queue[0].url, called_internally=True)
-                asyncio.run_coroutine_threadsafe(coro, self.bot.loop)
-            else:
-                coro = voice.disconnect()
-                asyncio.run_coroutine_threadsafe(coro, self.bot.loop)
 
-                coro = self.bot.change_presence(status=discord.Status.online, activity=None)
-                asyncio.run_coroutine_threadsafe(coro, self.bot.loop)
+class MusicManager():
+    def __init__(self, bot, db, music_text_channel_ids, music_voice_channel_ids, cache_path, cache_max_bytes, stream=True):
+        self.bot = bot
+        self.cache = AudioCache(db, cache_path, cache_max_bytes)
+        # Channels can be given as a single id, or a list of them (one per server, say)
+        self.music_text_channel_ids = set(music_text_channel_ids if isinstance(music_text_channel_ids, list) else [music_text_channel_ids])
+        self.music_voice_channel_ids = set(music_voice_channel_ids if isinstance(music_voice_channel_ids, list) else [music_voice_channel_ids])
+        # Stream tracks as they play, rather than downloading them first
+        self.stream = stream
+        # guild id --> GuildPlayer
+        self.players = {}
+        # video id --> track info, and --> the lookup running for it right now
+        self.track_info = TTLCache(TRACK_INFO_CACHE_TTL, max_size=TRACK_INFO_CACHE_SIZE)
+        self.track_info_lookups = {}
+        # video id --> the fetch into the cache running for it right now
+        self.downloads = {}
 
-        
-        voice = discord.utils.get(self.bot.voice_clients, guild=message.guild)
-        voice.play(discord.FFmpegOpusAudio(SONG_FILENAME, bitrate=128), after=finish_playing)
-        voice.is_playing()
-        return await message.reply(f"😸 🎵  **Now playing:** *{data['title']}*  🎵")
 
+    async def initialize(self):
+        await self.cache.load()
 
-    async def stop(self, message):
-        if message.channel.id != self.music_text_channel_id:
+
+    def register_commands(self, registry):
+        registry.register('music', self.music_command, MUSIC_ARGS_REGEX)
+
+
+    async def music_command(self, message, command, url):
+        if command == 'play' and url:
+            await self.play(message, url)
+        elif command == 'stop':
+            await self.stop(message)
+        elif command in ('list', 'queue', 'peek'):
+            await self.peek(message)
+        elif command == 'stats':
+            await self.stats(message)
+
+
+    def player(self, guild):
+        if guild.id not in self.players:
+            self.players[guild.id] = GuildPlayer(self, guild)
+        return self.players[guild.id]
+
+
+    def pinned(self):
+        # Every song queued in any server, which the cache mustn't evict
+        return {item.video_id for player in self.players.values() for item in player.queue}
+
+
+    def _voice_channel(self, message):
+        # The server's music voice channel if it has one, otherwise wherever the requester is
+        channel = discord.utils.find(lambda channel: channel.id in self.music_voice_channel_ids, message.guild.voice_channels)
+        if channel is None and getattr(message.author, 'voice', None):
+            channel = message.author.voice.channel
+        return channel
+
+
+    def _extract_info(self, url):
+        with youtube_dl.YoutubeDL({'format': AUDIO_FORMAT}) as ydl:
+            return ydl.extract_info(url, download=False)
+
+
+    async def _timed_extract_info(self, url):
+        with METRICS.timer('external_call_seconds', service='youtube'):
+            return await asyncio.get_event_loop().run_in_executor(None, self._extract_info, url)
+
+
+    async def get_track_info(self, url):
+        # Looking a track up hits the network, so it's done in a thread. Asking for the same video
+        # again while it's being looked up waits on that same lookup.
+        key = video_id(url)
+        data = self.track_info.get(key)
+        if data is not None:
+            return data
+
+        if key not in self.track_info_lookups:
+            lookup = asyncio.ensure_future(self._timed_extract_info(url))
+            self.track_info_lookups[key] = lookup
+            lookup.add_done_callback(lambda _: self.track_info_lookups.pop(key, None))
+        data = await asyncio.shield(self.track_info_lookups[key])
+        self.track_info.put(key, data)
+        return data
+
+
+    def _download(self, url, path):
+        # Only the audio is kept, as opus, so the file can go to discord without being re-encoded
+        ydl_opts = {
+            'format': AUDIO_FORMAT,
+            'outtmpl': os.path.splitext(path)[0] + '.%(ext)s',
+            'nooverwrites': False,
+            'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}],
+        }
+        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([url])
+
+
+    def download(self, item):
+        # Queue entries for the same video share a file, so they share its fetch too, whichever server they're in
+        key = item.video_id
+        if key not in self.downloads:
+            fetch = asyncio.ensure_future(self.fetch(item))
+            self.downloads[key] = fetch
+            fetch.add_done_callback(lambda _: self.downloads.pop(key, None))
+        return self.downloads[key]
+
+
+    async def fetch(self, item):
+        # Makes sure a track is in the cache, downloading it if it isn't. Anything going wrong just
+        # means this one track is skipped, so it never raises into the player.
+        try:
+            if await self.cache.lookup(item.video_id):
+                return True
+            with METRICS.timer('external_call_seconds', service='youtube_download'):
+                await asyncio.get_event_loop().run_in_executor(None, self._download, item.url, item.path)
+            # Whatever's still queued can't be evicted to make room
+            await self.cache.add(item.video_id, pinned=self.pinned())
+        except Exception:
+            logging.exception(f'Failed to fetch {item.url} into the cache.')
+            return False
+        return True
+
+
+    async def play(self, message, url):
+        if message.channel.id not in self.music_text_channel_ids:
             return await message.channel.send(f'{message.author.mention}, {DISALLOW_MESSAGE}')
 
-        voice = discord.utils.get(self.bot.voice_clients, guild=message.guild)
-        if voice.is_playing() or voice.is_connected() or self.queue:
-            try:
-                os.remove(SONG_FILENAME)
-            except Exception:
-                pass
+        voice_channel = self._voice_channel(message)
+        if voice_channel is None:
+            return await message.channel.send(f'{message.author.mention}, {NO_VOICE_CHANNEL_MESSAGE}')
+
+        try:
+            data = await self.get_track_info(url)
+        except youtube_dl.utils.DownloadError:
+            logging.exception(f'Failed to look up {url}.')
+            return await message.channel.send("😿  I couldn't find that song.")
 
-            self.queue = []
-            await self.bot.change_presence(status=discord.Status.online, activity=None)
-            return await voice.disconnect()
+        player = self.player(message.guild)
+        # If something's already playing, the new song just waits its turn
+        already_playing = player.playing
+        player.enqueue(QueueItem(message, url, data, self.cache.path(data['id']), voice_channel))
+        if already_playing:
+            return await message.channel.send("Song added to the queue.")
+
+
+    async def stop(self, message):
+        if message.channel.id not in self.music_text_channel_ids:
+            return await message.channel.send(f'{message.author.mention}, {DISALLOW_MESSAGE}')
+
+        player = self.players.get(message.guild.id)
+        if player and (player.playing or player.voice):
+            await player.stop()
+            await self.cache.evict(pinned=self.pinned())
         else:
             await message.channel.send("No song is playing!")
 
 
     async def peek(self, message):
-        if message.channel.id != self.music_text_channel_id:
+        if message.channel.id not in self.music_text_channel_ids:
             return await message.channel.send(f'{message.author.mention}, {DISALLOW_MESSAGE}')
 
-        if not self.queue:
+        player = self.players.get(message.guild.id)
+        if not player or not player.queue:
             return await message.channel.send("No song is playing!")
 
-        now_playing = f'>>> `NOW PLAYING` - **{self.queue[0].title}**'
-        up_next = '\n\nUp next...\n' + '\n'.join([_.title for _ in self.queue[1:]]) if len(self.queue) > 1 else ''
+        queue = list(player.queue)
+        now_playing = f'>>> `NOW PLAYING` - **{queue[0].title}**'
+        up_next = '\n\nUp next...\n' + '\n'.join([_.title for _ in queue[1:]]) if len(queue) > 1 else ''
         return await message.channel.send(f'Here are the upcoming songs...\n{now_playing}{up_next}', embed=None)
 
+
+    async def stats(self, message):
+        if message.channel.id not in self.music_text_channel_ids:
+            return await message.channel.send(f'{message.author.mention}, {DISALLOW_MESSAGE}')
+
+        stats = self.cache.stats()
+        return await message.channel.send(f"😸  I've got {stats['songs']} songs saved "
+            f"({stats['bytes'] / 1024 / 1024:.1f} of {stats['max_bytes'] / 1024 / 1024:.0f} MB). "
+            f"Since I woke up, {stats['hit_rate']:.0%} of songs were already saved "
+            f"({stats['hits']} hits, {stats['misses']} misses).")
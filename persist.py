@@ -1,8 +1,14 @@
+import time
+import json
+import asyncio
 import aiosqlite
 import logging
 
-from photos import Photo, Album
+from metrics import timed_methods
 
+
+# Every query method's latency goes into the db_query_seconds histogram
+@timed_methods('db_query_seconds')
 class DatabaseManager():
     def __init__(self, sqlite3_file):
         self.dbpath = sqlite3_file
@@ -11,26 +17,192 @@ class DatabaseManager():
     async def initialize(self):
         async with aiosqlite.connect(self.dbpath) as db:
             logging.info("Connecting to and preparing SQLITE database...")
-            await db.execute('CREATE TABLE IF NOT EXISTS CACHED_TWEETS (tweet_id varchar(255), channel_id varchar(255), UNIQUE(tweet_id, channel_id))')
+            # Incremental auto-vacuum lets the tweet retention job hand pages back to the filesystem.
+            # Switching modes on an existing database only takes effect after a full VACUUM, which is done once.
+            async with db.execute('PRAGMA auto_vacuum') as cursor:
+                auto_vacuum = (await cursor.fetchone())[0]
+            if auto_vacuum != 2:
+                logging.info("Enabling incremental auto-vacuum (one-time full VACUUM)...")
+                await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                await db.execute('VACUUM')
+
+            await db.execute('CREATE TABLE IF NOT EXISTS CACHED_TWEETS (tweet_id varchar(255), channel_id varchar(255), created_at int, UNIQUE(tweet_id, channel_id))')
+            # Older databases don't have the timestamp column. Backfill with "now" so legacy rows get a full retention horizon.
+            async with db.execute('PRAGMA table_info(CACHED_TWEETS)') as cursor:
+                columns = [row[1] for row in await cursor.fetchall()]
+            if 'created_at' not in columns:
+                await db.execute('ALTER TABLE CACHED_TWEETS ADD COLUMN created_at int')
+                await db.execute('UPDATE CACHED_TWEETS SET created_at = ?', (int(time.time()),))
+            await db.execute('CREATE INDEX IF NOT EXISTS CACHED_TWEETS_CREATED_AT ON CACHED_TWEETS (created_at)')
+            await db.execute('CREATE TABLE IF NOT EXISTS CALENDAR_SYNC (calendar_id varchar(255), sync_token text, UNIQUE(calendar_id))')
+            await db.execute('CREATE TABLE IF NOT EXISTS CALENDAR_EVENTS (calendar_id varchar(255), event_id varchar(255), event text, UNIQUE(calendar_id, event_id))')
+            await db.execute('CREATE TABLE IF NOT EXISTS SENT_REMINDERS (event_id varchar(255), start_time varchar(255), look_ahead int, channel_id varchar(255), expires_at int, UNIQUE(event_id, start_time, look_ahead, channel_id))')
+            await db.execute('CREATE TABLE IF NOT EXISTS SUMMARIES (content_hash varchar(255), summary text, created_at int, UNIQUE(content_hash))')
+            await db.execute('CREATE TABLE IF NOT EXISTS AUDIO_CACHE (video_id varchar(255), filename varchar(255), bytes int, last_played real, plays int DEFAULT 0, UNIQUE(video_id))')
+            await db.execute('CREATE TABLE IF NOT EXISTS TWEET_CURSORS (cursor_key varchar(255), since_id varchar(255), UNIQUE(cursor_key))')
             await db.execute('CREATE TABLE IF NOT EXISTS ALBUMS (album_name varchar(255), creator varchar(255), UNIQUE(album_name))')
             await db.execute('CREATE TABLE IF NOT EXISTS PHOTOS (photo_name varchar(255), album_name varchar(255), uploader varchar(255), freq int DEFAULT 0, UNIQUE(photo_name, album_name))')
+            await db.commit()
             logging.info("Done.")
 
 
     async def add_tweet(self, tweet_id, channel_id):
         async with aiosqlite.connect(self.dbpath) as db:
-            await db.execute(f"INSERT OR IGNORE INTO CACHED_TWEETS (tweet_id, channel_id) VALUES ('{tweet_id}', '{channel_id}')")
+            await db.execute("INSERT OR IGNORE INTO CACHED_TWEETS (tweet_id, channel_id, created_at) VALUES (?, ?, ?)",
+                (str(tweet_id), str(channel_id), int(time.time())))
             await db.commit()
         return True
 
 
     async def already_seen(self, tweet_id, channel_id):
         async with aiosqlite.connect(self.dbpath) as db:
-            async with db.execute(f"SELECT * FROM CACHED_TWEETS WHERE tweet_id = '{tweet_id}' AND channel_id = '{channel_id}'") as cursor:
+            async with db.execute("SELECT 1 FROM CACHED_TWEETS WHERE tweet_id = ? AND channel_id = ?", (str(tweet_id), str(channel_id))) as cursor:
                 return await cursor.fetchone() != None
         return False
 
 
+    async def prune_tweets(self, older_than, batch_size=500, vacuum_pages=0):
+        '''
+        Deletes cached tweets inserted before the unix timestamp older_than, in batches of batch_size
+        so that the database is never locked for long. Returns the number of rows removed.
+        If vacuum_pages is set, up to that many free pages are released with an incremental vacuum afterwards.
+        '''
+        removed = 0
+        async with aiosqlite.connect(self.dbpath) as db:
+            while True:
+                async with db.execute("DELETE FROM CACHED_TWEETS WHERE rowid IN \
+                    (SELECT rowid FROM CACHED_TWEETS WHERE created_at < ? LIMIT ?)", (older_than, batch_size)) as cursor:
+                    await db.commit()
+                    removed += cursor.rowcount
+                    if cursor.rowcount < batch_size:
+                        break
+                # Give other coroutines a turn between batches
+                await asyncio.sleep(0)
+
+            if vacuum_pages:
+                await db.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+                await db.commit()
+        return removed
+
+
+    async def get_tweet_cursors(self):
+        async with aiosqlite.connect(self.dbpath) as db:
+            async with db.execute("SELECT cursor_key, since_id FROM TWEET_CURSORS") as cursor:
+                return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+    async def set_tweet_cursor(self, cursor_key, since_id):
+        async with aiosqlite.connect(self.dbpath) as db:
+            await db.execute("INSERT OR REPLACE INTO TWEET_CURSORS (cursor_key, since_id) VALUES (?, ?)", (cursor_key, since_id))
+            await db.commit()
+        return True
+
+
+    async def get_calendar_store(self, calendar_id):
+        '''
+        Returns the saved sync token and a dict of event_id --> event for a calendar.
+        '''
+        async with aiosqlite.connect(self.dbpath) as db:
+            sync_token = None
+            async with db.execute("SELECT sync_token FROM CALENDAR_SYNC WHERE calendar_id = ?", (calendar_id,)) as cursor:
+                row = await cursor.fetchone()
+                sync_token = row[0] if row else None
+
+            async with db.execute("SELECT event_id, event FROM CALENDAR_EVENTS WHERE calendar_id = ?", (calendar_id,)) as cursor:
+                events = {row[0]: json.loads(row[1]) for row in await cursor.fetchall()}
+            return sync_token, events
+
+
+    async def update_calendar_store(self, calendar_id, sync_token, upserts=(), deletes=(), replace=False):
+        '''
+        Mirrors a round of calendar syncing. If replace is set, every stored event for
+        the calendar is dropped first (a full sync).
+        '''
+        async with aiosqlite.connect(self.dbpath) as db:
+            if replace:
+                await db.execute("DELETE FROM CALENDAR_EVENTS WHERE calendar_id = ?", (calendar_id,))
+            await db.executemany("DELETE FROM CALENDAR_EVENTS WHERE calendar_id = ? AND event_id = ?",
+                [(calendar_id, event_id) for event_id in deletes])
+            await db.executemany("INSERT OR REPLACE INTO CALENDAR_EVENTS (calendar_id, event_id, event) VALUES (?, ?, ?)",
+                [(calendar_id, event['id'], json.dumps(event)) for event in upserts])
+            await db.execute("INSERT OR REPLACE INTO CALENDAR_SYNC (calendar_id, sync_token) VALUES (?, ?)", (calendar_id, sync_token))
+            await db.commit()
+        return True
+
+
+    async def get_sent_reminders(self):
+        '''
+        Returns a dict of (event_id, start_time, look_ahead, channel_id) --> expires_at for every reminder sent.
+        '''
+        async with aiosqlite.connect(self.dbpath) as db:
+            async with db.execute("SELECT event_id, start_time, look_ahead, channel_id, expires_at FROM SENT_REMINDERS") as cursor:
+                return {(row[0], row[1], row[2], int(row[3])): row[4] for row in await cursor.fetchall()}
+
+
+    async def add_sent_reminders(self, reminders):
+        '''
+        Records sent reminders, given as a list of ((event_id, start_time, look_ahead, channel_id), expires_at).
+        '''
+        async with aiosqlite.connect(self.dbpath) as db:
+            await db.executemany("INSERT OR REPLACE INTO SENT_REMINDERS (event_id, start_time, look_ahead, channel_id, expires_at) VALUES (?, ?, ?, ?, ?)",
+                [(key[0], key[1], key[2], str(key[3]), expires_at) for key, expires_at in reminders])
+            await db.commit()
+        return True
+
+
+    async def prune_sent_reminders(self, now):
+        async with aiosqlite.connect(self.dbpath) as db:
+            async with db.execute("DELETE FROM SENT_REMINDERS WHERE expires_at < ?", (now,)) as cursor:
+                await db.commit()
+                return cursor.rowcount
+
+
+    async def get_summary(self, content_hash):
+        async with aiosqlite.connect(self.dbpath) as db:
+            async with db.execute("SELECT summary FROM SUMMARIES WHERE content_hash = ?", (content_hash,)) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+
+    async def add_summary(self, content_hash, summary):
+        async with aiosqlite.connect(self.dbpath) as db:
+            await db.execute("INSERT OR REPLACE INTO SUMMARIES (content_hash, summary, created_at) VALUES (?, ?, ?)",
+                (content_hash, summary, int(time.time())))
+            await db.commit()
+        return True
+
+
+    async def get_audio_cache(self):
+        '''
+        Returns every cached song as (video_id, filename, bytes, plays), least recently played first.
+        '''
+        async with aiosqlite.connect(self.dbpath) as db:
+            async with db.execute("SELECT video_id, filename, bytes, plays FROM AUDIO_CACHE ORDER BY last_played") as cursor:
+                return await cursor.fetchall()
+
+
+    async def add_audio_cache_entry(self, video_id, filename, num_bytes):
+        async with aiosqlite.connect(self.dbpath) as db:
+            await db.execute("INSERT OR REPLACE INTO AUDIO_CACHE (video_id, filename, bytes, last_played, plays) VALUES (?, ?, ?, ?, 0)",
+                (video_id, filename, num_bytes, time.time()))
+            await db.commit()
+        return True
+
+
+    async def touch_audio_cache_entry(self, video_id):
+        async with aiosqlite.connect(self.dbpath) as db:
+            await db.execute("UPDATE AUDIO_CACHE SET last_played = ?, plays = plays + 1 WHERE video_id = ?", (time.time(), video_id))
+            await db.commit()
+        return True
+
+
+    async def delete_audio_cache_entries(self, video_ids):
+        async with aiosqlite.connect(self.dbpath) as db:
+            await db.executemany("DELETE FROM AUDIO_CACHE WHERE video_id = ?", [(video_id,) for video_id in video_ids])
+            await db.commit()
+        return True
+
+
     async def create_album(self, album_name, creator):
         async with aiosqlite.connect(self.dbpath) as db:
             async with db.execute(f"INSERT INTO ALBUMS (album_name, creator) VALUES ('{album_name}', '{creator}')") as cursor:
@@ -78,6 +250,8 @@ class DatabaseManager():
                 args.append(album_name)
 
             query += (' WHERE ' + ' AND '.join(criteria)) if criteria else ''
+            # photos is only imported by instances that actually use petpic
+            from photos import Album
             async with db.execute(query, tuple(args)) as cursor:
                 return [Album(**row) for row in await cursor.fetchall()]
 
@@ -134,6 +308,7 @@ class DatabaseManager():
 
             query += (' WHERE ' + ' AND '.join(criteria)) if criteria else ''
 
+            from photos import Photo
             async with db.execute(query, tuple(args)) as cursor:
                 return [Photo(**row) for row in await cursor.fetchall()]
 
@@ -72,6 +72,9 @@ ACCEPTABLE_FILETYPES = ('jpg', 'jpeg', 'gif', 'png', 'tiff')
 
 MAX_PHOTO_SIZE = 25165824
 
+# !petpic <command> [album] [url]
+PETPIC_ARGS_REGEX = r'(add|create|delete|list|random|remove|upload|wipe|share)(?: ([^\s\\]+))?(?: (.+))?'
+
 
 def requires_disclaimer(fn):
     '''
@@ -123,6 +126,30 @@ class PhotosManager():
         self.sent_command_cache = {}
 
 
+    def register_commands(self, registry):
+        registry.register('petpic', self.petpic_command, PETPIC_ARGS_REGEX, subcommand_aliases={'add': 'upload', 'remove': 'delete'})
+
+
+    async def petpic_command(self, message, cmd, album_name, extra):
+        album_name = album_name.lower() if album_name else None
+        if cmd in ('add', 'upload') and album_name:
+            await self.upload(message, album_name, extra)
+        elif cmd == 'random':
+            await self.fetch(message, album_name)
+        elif cmd == 'list':
+            await self.list_albums(message, all_albums=album_name == 'all')
+        elif cmd == 'create' and album_name:
+            await self.create_album(message, album_name)
+        elif cmd in ('delete', 'remove') and album_name:
+            await self.delete_album(message, album_name)
+        elif cmd == 'wipe':
+            await self.wipe(message)
+        elif cmd == 'share' and album_name:
+            await self.share_album(message, album_name)
+        else:
+            await message.channel.send('😾  Not like this! Check `!help` for details on how to use `!petpic`.')
+
+
     async def initialize(self):
         '''
         Indexes all unindexed photos.
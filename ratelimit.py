@@ -0,0 +1,144 @@
+import time
+import asyncio
+import logging
+
+from util import LRUCache, TTLCache
+
+# Unless config.yml says otherwise, each user can run this many commands a minute, in bursts of up to this many
+DEFAULT_PER_MINUTE = 20
+DEFAULT_BURST = 5
+# Buckets are kept for this many users (and user/command pairs). Anyone forgotten just starts with a full bucket.
+BUCKET_CACHE_SIZE = 1024
+# Someone who's rate limited is told so at most once in this many seconds. Anything else they send is ignored.
+WARNING_COOLDOWN = 30
+
+RATE_LIMITED_MESSAGE = '😾  Slow down! Try that again in {seconds}s.'
+
+
+class TokenBucket():
+    '''
+    Holds up to capacity tokens, refilled at rate tokens per second. Each command takes one.
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+    def retry_after(self):
+        # Seconds until there's a whole token again
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter():
+    '''
+    Sits in front of command dispatch. Every user gets a token bucket shared by all their commands, and
+    commands listed in config get their own bucket per user on top of that. Those commands can also cap how
+    many of them run at once across everyone, so a pile of uploads or summaries can't starve the rest of the bot.
+
+    A command with subcommands can be limited one subcommand at a time, by listing it as "command subcommand".
+    That way only the heavy ones (petpic upload, music play) wait for a slot, and petpic list or music stop
+    never queue up behind them.
+
+    The config looks like:
+        default:
+          per_minute: 20
+          burst: 5
+        commands:
+          summarize:
+            per_minute: 2
+            burst: 1
+            concurrency: 1
+          petpic upload:
+            per_minute: 10
+            burst: 3
+            concurrency: 2
+    '''
+    def __init__(self, config=None):
+        config = config or {}
+        default = config.get('default') or {}
+        # A per_minute of 0 turns that limit off
+        self.default_rate = default.get('per_minute', DEFAULT_PER_MINUTE) / 60
+        self.default_burst = default.get('burst', DEFAULT_BURST)
+        self.command_limits = config.get('commands') or {}
+
+        # user id --> TokenBucket, and (user id, command) --> TokenBucket
+        self.user_buckets = LRUCache(max_size=BUCKET_CACHE_SIZE)
+        self.command_buckets = LRUCache(max_size=BUCKET_CACHE_SIZE)
+        # command (or "command subcommand") --> Semaphore, for those with a concurrency cap
+        self.semaphores = {name: asyncio.Semaphore(limits['concurrency'])
+            for name, limits in self.command_limits.items() if limits.get('concurrency')}
+        # Users who've already been told they're rate limited
+        self.warned = TTLCache(WARNING_COOLDOWN, max_size=BUCKET_CACHE_SIZE)
+        self.rejected = 0
+
+
+    def _bucket(self, cache, key, rate, capacity):
+        bucket = cache.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, capacity)
+            cache.put(key, bucket)
+        return bucket
+
+
+    def limit_name(self, command, subcommand=None):
+        '''
+        What a command's limits are listed under: "command subcommand" if that has its own, otherwise just command.
+        '''
+        if subcommand and f'{command} {subcommand}' in self.command_limits:
+            return f'{command} {subcommand}'
+        return command
+
+
+    def check(self, user_id, command):
+        '''
+        Takes a token for running command. Returns 0 if it's allowed, otherwise how many seconds until it would be.
+        '''
+        buckets = []
+        if self.default_rate:
+            buckets.append(self._bucket(self.user_buckets, user_id, self.default_rate, self.default_burst))
+        limits = self.command_limits.get(command)
+        if limits and limits.get('per_minute'):
+            buckets.append(self._bucket(self.command_buckets, (user_id, command),
+                limits['per_minute'] / 60, limits.get('burst', 1)))
+
+        # Only spend tokens if every bucket has one, so a rejected command doesn't cost anything
+        waits = [_.retry_after() for _ in buckets]
+        if waits and max(waits) > 0:
+            self.rejected += 1
+            return max(waits)
+        for bucket in buckets:
+            bucket.take()
+        return 0
+
+
+    async def allow(self, message, command):
+        '''
+        Whether message may run command. If not, the user is told so (once in a while) and it's dropped.
+        '''
+        retry_after = self.check(message.author.id, command)
+        if not retry_after:
+            return True
+
+        logging.info(f'Rate limited {message.author} on !{command}.')
+        if message.author.id not in self.warned:
+            self.warned.put(message.author.id, True)
+            await message.channel.send(RATE_LIMITED_MESSAGE.format(seconds=max(1, round(retry_after))))
+        return False
+
@@ -1,32 +1,139 @@
+import heapq
 import logging
+import dataclasses
 import discord
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2 import service_account
+from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from datetime import datetime, timedelta, timezone
 from dateutil import tz
 from calendar import monthrange
 from requests.structures import CaseInsensitiveDict
 from bs4 import BeautifulSoup
 
+from util import LRUCache, TTLCache
+from metrics import METRICS
+
 SCOPES = ['https://www.googleapis.com/auth/calendar']
-# Poll interval in seconds
-CALENDAR_POLL_INTERVAL = 30
+# How often (seconds) each calendar is synced to pick up new or changed events. Syncs are incremental,
+# so an interval with no changes costs one tiny request.
+CALENDAR_REFRESH_INTERVAL = 60
+# How far back the initial full sync of a calendar reaches. Older events are dropped from the local store.
+CALENDAR_SYNC_LOOKBACK = timedelta(days=1)
+# Rendered event text is memoized (keyed on the event's id and last update) up to this many events,
+# and the full !events response for a calendar is reused for this many seconds.
+RENDERED_EVENT_CACHE_SIZE = 256
+UPCOMING_EVENTS_CACHE_TTL = 60
+# Reminders whose time passed less than this long ago (an event added at the last minute, or a reminder
+# that came due while the bot was restarting) are still sent
+REMINDER_GRACE_PERIOD = timedelta(minutes=5)
 
 EASTERN_TIMEZONE = tz.gettz('America/New_York')
 UTC_TIMEZONE = tz.tzutc()
 
+
+@dataclasses.dataclass(order=True)
+class ReminderTrigger:
+    fire_time: datetime
+    # Position of the event in the calendar's listing, to keep events that start together in order
+    position: int
+    # Labels can share a calendar, and each one's reminders are planned separately
+    calendar_label: str = dataclasses.field(compare=False)
+    calendar_id: str = dataclasses.field(compare=False)
+    event: dict = dataclasses.field(compare=False)
+    channel: discord.abc.Messageable = dataclasses.field(compare=False)
+    look_ahead: int = dataclasses.field(compare=False)
+    ping: bool = dataclasses.field(compare=False)
+
+    @property
+    def key(self):
+        # A reminder is identified by the event (and when it starts, in case it gets moved), the offset, and where it goes
+        return (self.event['id'], self.event['start']['dateTime'], self.look_ahead, self.channel.id)
+
+
+class SentReminders():
+    '''
+    Remembers which reminders have gone out, so that re-planning never sends one twice. An entry is only
+    needed until its event has started (plus the grace period), after which it's forgotten. Mirrored to the DB.
+    '''
+    def __init__(self, db):
+        self.db = db
+        # ReminderTrigger.key --> unix timestamp when it can be forgotten
+        self.expiries = {}
+
+
+    def __contains__(self, key):
+        return key in self.expiries
+
+
+    def __len__(self):
+        return len(self.expiries)
+
+
+    async def load(self):
+        self.expiries = await self.db.get_sent_reminders()
+        await self.prune()
+
+
+    async def add(self, triggers):
+        added = []
+        for trigger in triggers:
+            start = datetime.fromisoformat(trigger.event['start']['dateTime'])
+            expires_at = int((start + REMINDER_GRACE_PERIOD).timestamp())
+            self.expiries[trigger.key] = expires_at
+            added.append((trigger.key, expires_at))
+        await self.db.add_sent_reminders(added)
+
+
+    async def prune(self):
+        now = int(datetime.now(timezone.utc).timestamp())
+        self.expiries = {key: expires_at for key, expires_at in self.expiries.items() if expires_at >= now}
+        await self.db.prune_sent_reminders(now)
+
+
 class ReminderManager():
-    def __init__(self, bot, google_creds, relay_map):
+    def __init__(self, bot, db, google_creds, relay_map):
         self.bot = bot
+        self.db = db
         self.google_creds = google_creds
         self.relay_map = CaseInsensitiveDict(relay_map)
         self.tasks = []
 
+        # The credentials and service object are built once and reused. The underlying httplib2
+        # transport is not thread safe, so every API call goes through a single dedicated worker.
+        self.credentials = None
+        self.service = None
+        self.auth_lock = asyncio.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='calendar')
+
+        # Min-heap of upcoming ReminderTriggers, ordered by fire time. A single scheduler task sleeps until
+        # the earliest one is due, and is woken up early whenever a calendar refresh re-plans the heap.
+        self.triggers = []
+        self.replan = asyncio.Event()
+        # Reminders that have already gone out
+        self.sent = SentReminders(db)
+
+        # Local copy of each calendar, kept up to date with incremental syncs and mirrored to the DB.
+        # calendar_id --> {event_id --> event}, and calendar_id --> nextSyncToken
+        self.event_stores = {}
+        self.sync_tokens = {}
+        self.sync_locks = {}
+
+        self.rendered_events = LRUCache(max_size=RENDERED_EVENT_CACHE_SIZE)
+        self.upcoming_events_responses = TTLCache(UPCOMING_EVENTS_CACHE_TTL, max_size=max(len(self.relay_map), 1))
+
 
     async def initialize(self):
         logging.info("Initializing google calendar reminders...")
-        # For each google calendar, create a new async task that will poll for upcoming events
+        await self.sent.load()
+        logging.info(f"\tLoaded {len(self.sent)} recently sent reminders.")
+        # Several labels can point at the same google calendar (to remind different channels at different times, say).
+        # Each calendar gets one async task that refreshes its upcoming events, and plans reminders for every label using it.
+        # calendar_id --> [(calendar_label, channels, when_to_notify, ping)]
+        watched = {}
         for calendar_label in self.relay_map.keys():
             config = self.relay_map[calendar_label]
             
@@ -44,101 +151,226 @@ class ReminderManager():
                 else:
                     channels.append(channel)
             logging.info(f"\tWatching for events from Google Calendar {calendar_label} with id {calendar_id}...")
-            self.tasks.append(asyncio.create_task(self.poll_calendar_events(calendar_id, channels, when_to_notify, ping)))
+            watched.setdefault(calendar_id, []).append((calendar_label, channels, when_to_notify, ping))
+        for calendar_id, subscriptions in watched.items():
+            self.tasks.append(asyncio.create_task(self.refresh_calendar_events(calendar_id, subscriptions)))
+        self.tasks.append(asyncio.create_task(self.run_scheduler()))
         logging.info("Done.")
 
 
     async def auth(self):
-        # Grabs an authenticated endpoint for pulling calendar data
-        credentials = service_account.Credentials.from_service_account_file(self.google_creds, scopes=SCOPES)
-        return build('calendar', 'v3', credentials=credentials, cache_discovery=False)
+        # Grabs an authenticated endpoint for pulling calendar data, building it on first use
+        async with self.auth_lock:
+            if not self.service:
+                loop = asyncio.get_running_loop()
+                self.service = await loop.run_in_executor(self.executor, self._build_service)
+        return self.service
 
 
-    async def poll_calendar_events(self, calendar_id, channels, when_to_notify, ping):
-        # This cache is local to only this running coroutine
-        # We only want to notify an event for a particular "minutes until event" trigger one time
-        cache = {}
-        logging.info('Spawned a poll watcher. Trump would be proud.')
-        for look_ahead in when_to_notify:
-            cache[look_ahead] = set()
+    def _build_service(self):
+        '''
+        NOT AN ASYNC METHOD - MUST RUN IN A THREAD
+        '''
+        self.credentials = service_account.Credentials.from_service_account_file(self.google_creds, scopes=SCOPES)
+        return build('calendar', 'v3', credentials=self.credentials, cache_discovery=False)
 
+
+    async def execute(self, request):
+        # Runs a prepared API request on the calendar worker thread, so the event loop never blocks on it
+        await self.auth()
+        loop = asyncio.get_running_loop()
+        with METRICS.timer('external_call_seconds', service='google_calendar'):
+            return await loop.run_in_executor(self.executor, self._execute, request)
+
+
+
+    def _execute(self, request):
+        '''
+        NOT AN ASYNC METHOD - MUST RUN IN A THREAD
+        '''
+        # Only refresh the access token once it has actually expired
+        if self.credentials and not self.credentials.valid:
+            logging.info('Refreshing Google Calendar credentials...')
+            self.credentials.refresh(Request())
+        return request.execute()
+
+
+    async def refresh_calendar_events(self, calendar_id, subscriptions):
+        logging.info('Spawned a calendar watcher. Trump would be proud.')
         while True:
-            # Grab a timezone-aware timestamp for "now", in UTC time
-            right_now = datetime.now(timezone.utc)
+            try:
+                # Grab a timezone-aware timestamp for "now", in UTC time
+                right_now = datetime.now(timezone.utc)
+
+                # Everything that could need a reminder before the next refresh. Look back by the grace
+                # period too, so a reminder that came due just before this refresh isn't dropped.
+                await self.sync_calendar(calendar_id)
+                for calendar_label, channels, when_to_notify, ping in subscriptions:
+                    horizon = right_now + timedelta(minutes=max(when_to_notify), seconds=CALENDAR_REFRESH_INTERVAL)
+                    events = self.events_in_range(calendar_id, right_now - REMINDER_GRACE_PERIOD, horizon)
+                    self.plan(calendar_label, calendar_id, events, channels, when_to_notify, ping)
+            except Exception as e:
+                logging.exception(f'Exception thrown while attempting to check events on calendar {calendar_id}')
+            await asyncio.sleep(CALENDAR_REFRESH_INTERVAL)
+
+
+    def plan(self, calendar_label, calendar_id, events, channels, when_to_notify, ping):
+        # Replaces every pending trigger for this label with ones built from the freshly fetched events
+        right_now = datetime.now(timezone.utc)
+        triggers = [trigger for trigger in self.triggers if trigger.calendar_label != calendar_label]
+        for position, event in enumerate(events):
+            start = datetime.fromisoformat(event['start']['dateTime'])
             for look_ahead in when_to_notify:
-                # Based on the "minutes until event" value, create a "look ahead" window of a minute
-                # Ex: imagine a value of "2" for "2 minutes before event, notify"
-                #
-                #         now                              look ahead window
-                #      (12:00:30)                          |---------------|
-                #   |--------------|---------------|--------------|--------------|
-                # 12:00          12:01           12:02          12:03          12:04
-                #
-                # TODO: This isn't ideal. This window of one minute means that we're notifying
-                # up to a minute too soon, depending on where "now" falls on the seconds clock.
-                start_after = right_now + timedelta(minutes=look_ahead)
-                start_before = start_after + timedelta(minutes=1)
+                fire_time = start - timedelta(minutes=look_ahead)
+                if fire_time < right_now - REMINDER_GRACE_PERIOD:
+                    continue
                 for channel in channels:
-                    newline = "\n"
-                    await self.get_events_in_window(
-                        calendar_id, start_after, start_before, channel, look_ahead, cache[look_ahead],
-                        f'📅  🐱 💬  {"@here " if ping else ""}' +
-                            f'Events are starting {"in " + str(look_ahead) + " minutes" if look_ahead > 0 else "now"}!'
-                    )
-            await asyncio.sleep(CALENDAR_POLL_INTERVAL)
-
-
-    async def get_events_in_window(self, calendar_id, start_after, start_before, channel, look_ahead, cache, prompt):
-        try:
-            # Construct the query to Google Calendar. We're only able to provide a cutoff for starting after a date.
-            # So we'll validate the "starting before" the other end of the window later.
-            service = await self.auth()
-            result = service.events().list(
-                calendarId=calendar_id,
-                singleEvents=True,
-                orderBy='startTime',
-                timeMin=f'{start_after.isoformat(timespec="seconds")}',
-                maxResults=5
-            ).execute()
-
-            # Edge case - no data comes back
-            if 'items' not in result:
-                return
-
-            # Filter out anything that's not an event
-            future_events = [item for item in result['items'] if 'kind' in item and item['kind'] == 'calendar#event']
-
-            # Filter out anything that's already in the cache
-            uncached_future_events = [item for item in future_events if item['id'] not in cache]
-            if not uncached_future_events:
-                return
+                    trigger = ReminderTrigger(fire_time, position, calendar_label, calendar_id, event, channel, look_ahead, ping)
+                    if trigger.key not in self.sent:
+                        triggers.append(trigger)
 
-            # Some events may only have a date. This just converts those dates to datetime objects (midnight on date).
-            await self._change_events_start_date_to_datetime(uncached_future_events)
-
-            # Filter out anything that's not actually in the "window"
-            to_notify = []
-            for future_event in uncached_future_events:
-                start = future_event['start']
-                when = datetime.fromisoformat(future_event['start']['dateTime'])
-                if when >= start_after and when < start_before:
-                    to_notify.append(future_event)
-            if not to_notify:
-                return
-
-            # Construct the message for the notification.
-            msg = f"{prompt}\n"
-            for future_event in to_notify:
-                if future_event['id'] in cache:
-                    continue
+        heapq.heapify(triggers)
+        self.triggers = triggers
+        self.replan.set()
+
+
+    async def run_scheduler(self):
+        while True:
+            self.replan.clear()
+
+            # Pop everything that's due, and send it
+            due = []
+            while self.triggers and self.triggers[0].fire_time <= datetime.now(timezone.utc):
+                due.append(heapq.heappop(self.triggers))
+            if due:
+                try:
+                    await self.fire(due)
+                except Exception as e:
+                    logging.exception('Exception thrown while attempting to send reminders')
+
+            # Sleep until the next trigger is due, or until the heap gets re-planned
+            timeout = None
+            if self.triggers:
+                timeout = max((self.triggers[0].fire_time - datetime.now(timezone.utc)).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self.replan.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def fire(self, triggers):
+        # Reminders for the same calendar, offset, and channel that come due together go out as one message
+        batches = {}
+        unsent = []
+        for trigger in triggers:
+            if trigger.key in self.sent:
+                continue
+            unsent.append(trigger)
+            batches.setdefault((trigger.calendar_id, trigger.look_ahead, trigger.channel.id), []).append(trigger)
+        if not unsent:
+            return
+
+        # Mark them as sent up front, so a failure halfway through doesn't cause a repeat
+        await self.sent.prune()
+        await self.sent.add(unsent)
 
-                cache.add(future_event['id'])
-                event_as_str = await self._render_event(future_event)
+        for (calendar_id, look_ahead, channel_id), batch in batches.items():
+            ping = batch[0].ping
+            msg = f'📅  🐱 💬  {"@here " if ping else ""}' + \
+                f'Events are starting {"in " + str(look_ahead) + " minutes" if look_ahead > 0 else "now"}!\n'
+            for trigger in batch:
+                event_as_str = await self._render_event(trigger.event)
                 msg += f'```{event_as_str}```' + "\n"
-                logging.info(f"  Event {future_event['id']} reminder being sent from calendar {calendar_id} to channel {channel.id}.")
-            await channel.send(msg)
-        except Exception as e:
-            logging.exception(f'Exception thrown while attempting to check events on calendar {calendar_id} for channel {channel.id}')
+
+            try:
+                logging.info(f"  Reminder for events {', '.join([_.event['id'] for _ in batch])} being sent from calendar {calendar_id} to channel {channel_id}.")
+                await batch[0].channel.send(msg)
+            except Exception as e:
+                logging.exception(f'Exception thrown while attempting to send reminders from calendar {calendar_id} to channel {channel_id}')
+
+
+    async def sync_calendar(self, calendar_id):
+        # Brings the local event store for a calendar up to date. The first sync after startup loads the
+        # store from the DB, and only falls back to a full listing if there's no usable sync token.
+        lock = self.sync_locks.setdefault(calendar_id, asyncio.Lock())
+        async with lock:
+            if calendar_id not in self.event_stores:
+                self.sync_tokens[calendar_id], self.event_stores[calendar_id] = await self.db.get_calendar_store(calendar_id)
+
+            sync_token = self.sync_tokens[calendar_id]
+            try:
+                changes, next_sync_token = await self._list_events(calendar_id, sync_token)
+            except HttpError as e:
+                # 410 GONE means the sync token expired, and everything has to be fetched again
+                if e.resp.status != 410:
+                    raise
+                logging.info(f'Sync token for calendar {calendar_id} expired, doing a full sync.')
+                sync_token = None
+                changes, next_sync_token = await self._list_events(calendar_id, None)
+
+            store = {} if not sync_token else self.event_stores[calendar_id]
+            deletes = []
+            upserts = []
+            for event in changes:
+                if event.get('status') == 'cancelled':
+                    if store.pop(event['id'], None):
+                        deletes.append(event['id'])
+                elif event.get('kind') == 'calendar#event':
+                    store[event['id']] = event
+                    upserts.append(event)
+
+            # Some events may only have a date. This just converts those dates to datetime objects (midnight on date).
+            await self._change_events_start_date_to_datetime(upserts)
+
+            # Forget anything that's over and done with
+            cutoff = datetime.now(timezone.utc) - CALENDAR_SYNC_LOOKBACK
+            for event_id, event in list(store.items()):
+                if self._event_end(event) < cutoff:
+                    del store[event_id]
+                    deletes.append(event_id)
+
+            self.event_stores[calendar_id] = store
+            self.sync_tokens[calendar_id] = next_sync_token
+            await self.db.update_calendar_store(calendar_id, next_sync_token, upserts=upserts, deletes=deletes, replace=not sync_token)
+            if upserts or deletes:
+                self.upcoming_events_responses.pop(calendar_id)
+                logging.info(f'Synced calendar {calendar_id}: {len(upserts)} events added or changed, {len(deletes)} removed.')
+
+
+    async def _list_events(self, calendar_id, sync_token):
+        # Pulls either the changes since sync_token, or (without one) every event from the lookback onwards.
+        # Returns the raw items along with the token to use for the next sync.
+        service = await self.auth()
+        items = []
+        page_token = None
+        while True:
+            if sync_token:
+                request = service.events().list(calendarId=calendar_id, singleEvents=True, syncToken=sync_token, pageToken=page_token)
+            else:
+                time_min = datetime.now(timezone.utc) - CALENDAR_SYNC_LOOKBACK
+                request = service.events().list(calendarId=calendar_id, singleEvents=True, pageToken=page_token,
+                    timeMin=f'{time_min.isoformat(timespec="seconds")}')
+            result = await self.execute(request)
+            items.extend(result.get('items', []))
+
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                return items, result.get('nextSyncToken')
+
+
+    def events_in_range(self, calendar_id, time_min, time_max):
+        # Events from the local store that are still going on at time_min, and start before time_max, in start order
+        events = [event for event in self.event_stores.get(calendar_id, {}).values()
+            if self._event_end(event) > time_min and datetime.fromisoformat(event['start']['dateTime']) < time_max]
+        return sorted(events, key=lambda item: datetime.fromisoformat(item['start']['dateTime']))
+
+
+    def register_commands(self, registry):
+        registry.register('events', self.events_command, r'(.+)')
+
+
+    async def events_command(self, message, calendar_name):
+        await self.get_upcoming_events(message.channel, calendar_name=calendar_name)
 
 
     async def get_upcoming_events(self, channel, calendar_name=None):
@@ -153,6 +385,10 @@ class ReminderManager():
             return await channel.send(f'🙀  I only know of these calendars.\n```{available_calendars}```')
         
         calendar_id = self.relay_map[calendar_name]['calendar_id']
+        cached_response = self.upcoming_events_responses.get(calendar_id)
+        if cached_response:
+            return await channel.send(cached_response)
+
         right_now = right_now = datetime.now(timezone.utc)
         
         # Calculate the number of days to add to get to the last day of next month.
@@ -169,28 +405,15 @@ class ReminderManager():
 
         # Okay, now we have SOME time ON the last day. Let's cut that time off, and
         # force it to be the last second of the day.
-        last_day_of_next_month.strftime('%Y-%m-%d') + 'T23:59:59Z'
-
-        service = await self.auth()
-        result = service.events().list(
-            calendarId=calendar_id,
-            singleEvents=True,
-            orderBy='startTime',
-            timeMin=f'{right_now.isoformat(timespec="seconds")}',
-            timeMax=f'{last_day_of_next_month.strftime("%Y-%m-%d")}T23:59:59Z',
-            maxResults=20
-        ).execute()
-        if not 'items' in result:
-            return
+        end_of_next_month = datetime.fromisoformat(last_day_of_next_month.strftime('%Y-%m-%d') + 'T23:59:59+00:00')
 
-        future_events = [item for item in result['items'] if 'kind' in item and item['kind'] == 'calendar#event']
+        # Read from the local store, only syncing if the calendar hasn't been synced yet
+        if calendar_id not in self.event_stores:
+            await self.sync_calendar(calendar_id)
+        future_events = self.events_in_range(calendar_id, right_now, end_of_next_month)[:20]
         if not future_events:
             return
 
-        # Convert all events with only dates to have datetimes starting at midnight
-        await self._change_events_start_date_to_datetime(future_events)
-        future_events = sorted(future_events, key=lambda item: datetime.fromisoformat(item['start']['dateTime']))
-
         msg = "📅  🐱 💬  There are some meetings and events coming up...\n"
         for future_event in future_events:
             event_as_str = await self._render_event(future_event)
@@ -199,6 +422,7 @@ class ReminderManager():
                 break
 
             msg += f'```{event_as_str}```' + "\n"
+        self.upcoming_events_responses.put(calendar_id, msg)
         await channel.send(msg)
 
 
@@ -210,7 +434,24 @@ class ReminderManager():
                 future_event['start'] = new_start
 
 
+    def _event_end(self, event):
+        end = event.get('end', event['start'])
+        if 'dateTime' in end:
+            return datetime.fromisoformat(end['dateTime'])
+        return datetime.fromisoformat(end['date'] + 'T00:00:00+00:00')
+
+
     async def _render_event(self, future_event):
+        # Event content rarely changes, and the 'updated' timestamp moves whenever it does
+        cache_key = (future_event['id'], future_event.get('updated'), future_event['start']['dateTime'])
+        rendered = self.rendered_events.get(cache_key)
+        if rendered is None:
+            rendered = self._render_event_uncached(future_event)
+            self.rendered_events.put(cache_key, rendered)
+        return rendered
+
+
+    def _render_event_uncached(self, future_event):
         start = future_event['start']
         when = datetime.fromisoformat(future_event['start']['dateTime']).astimezone(EASTERN_TIMEZONE)
         when_str = when.strftime("%A, %d. %B %Y %I:%M%p %Z").replace('12:00AM EST', '')
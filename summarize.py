@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import logging
+
+from util import LRUCache
+from metrics import METRICS
+
+SUMMARY_MODEL = 'gemini-2.5-flash-preview-05-20'
+
+SUMMARY_INSTRUCTIONS = 'Summarize what happened in under 1900 characters, formatted for a discord message using a couple of cat-flavored emojis and perhaps a suggestion of cat puns. Finally, give a cute, overly enthusiastic shout-out to one of the members in attendance. Make the shout-out stress how that member is CLEARLY the most important member of the troupe, and  somehow include a reference to the content of the meeting.'
+SUMMARY_PROMPT = 'This is a log for a Tavern Troupe meeting. ' + SUMMARY_INSTRUCTIONS
+CHUNK_PROMPT = 'This is an excerpt from a log for a Tavern Troupe meeting. Write plain, factual notes on what happened in it: who was there, who said what, and anything notable. These notes will be combined with notes on the rest of the meeting.'
+MERGE_PROMPT = 'These are notes on consecutive parts of a log for a Tavern Troupe meeting, in order. ' + SUMMARY_INSTRUCTIONS
+
+# Logs longer than this (bytes) are split on line boundaries, and each piece is summarized on its own
+CHUNK_SIZE = 120000
+# How many model calls can be in flight at once, and how many chunk summaries are remembered
+MAX_CONCURRENT_REQUESTS = 4
+CHUNK_CACHE_SIZE = 256
+# How many whole logs can be summarized at once, and how many finished summaries are kept in memory
+MAX_CONCURRENT_SUMMARIES = 2
+SUMMARY_CACHE_SIZE = 64
+
+
+def split_log(payload, chunk_size=CHUNK_SIZE):
+    '''
+    Splits a log into pieces of at most roughly chunk_size bytes, without breaking up lines.
+    '''
+    chunks = []
+    current = []
+    current_size = 0
+    for line in payload.splitlines(keepends=True):
+        if current and current_size + len(line) > chunk_size:
+            chunks.append(b''.join(current))
+            current = []
+            current_size = 0
+        current.append(line)
+        current_size += len(line)
+    if current or not chunks:
+        chunks.append(b''.join(current))
+    return chunks
+
+
+class SummaryManager():
+    def __init__(self, api_key, db=None, client=None):
+        self.api_key = api_key
+        # If there's a DB, finished summaries are also saved there
+        self.db = db
+        # The model client is created on first use, and reused for every call after.
+        # Anything with the same aio.models.generate_content() interface can be passed in instead.
+        self.client = client
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # sha256 of a chunk --> its summary
+        self.chunk_summaries = LRUCache(max_size=CHUNK_CACHE_SIZE)
+
+        # sha256 of a log --> its summary, and --> the task summarizing it right now
+        self.summaries = LRUCache(max_size=SUMMARY_CACHE_SIZE)
+        self.in_flight = {}
+        self.summary_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SUMMARIES)
+
+
+    async def summarize_log(self, payload):
+        '''
+        Summarizes a meeting log (bytes). The same log is only ever summarized once: finished summaries
+        are cached by a hash of the log, and anyone asking while it's being worked on shares the result.
+        '''
+        content_hash = hashlib.sha256(payload).hexdigest()
+        summary = self.summaries.get(content_hash)
+        if summary is None and self.db:
+            summary = await self.db.get_summary(content_hash)
+        if summary is not None:
+            self.summaries.put(content_hash, summary)
+            return summary
+
+        if content_hash not in self.in_flight:
+            task = asyncio.create_task(self._summarize_and_save(payload, content_hash))
+            self.in_flight[content_hash] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(content_hash, None))
+        # Shielded, so one caller going away doesn't cancel it for everyone else
+        return await asyncio.shield(self.in_flight[content_hash])
+
+
+    async def _summarize_and_save(self, payload, content_hash):
+        async with self.summary_semaphore:
+            summary = await self._summarize(payload)
+        self.summaries.put(content_hash, summary)
+        if self.db:
+            await self.db.add_summary(content_hash, summary)
+        return summary
+
+
+    async def _summarize(self, payload):
+        # Short logs go to the model in one request. Longer ones are split, the pieces are
+        # summarized concurrently, and those notes are merged into the final summary.
+        chunks = split_log(payload)
+        if len(chunks) == 1:
+            return await self._generate([payload, SUMMARY_PROMPT])
+
+        logging.info(f'Summarizing a {len(payload)} byte log in {len(chunks)} pieces...')
+        notes = await asyncio.gather(*[self._summarize_chunk(chunk) for chunk in chunks])
+        merged = '\n\n'.join([f'Part {i + 1} of {len(notes)}:\n{note}' for i, note in enumerate(notes)])
+        return await self._generate([merged, MERGE_PROMPT])
+
+
+    async def _summarize_chunk(self, chunk):
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        summary = self.chunk_summaries.get(chunk_hash)
+        if summary is None:
+            summary = await self._generate([chunk, CHUNK_PROMPT])
+            self.chunk_summaries.put(chunk_hash, summary)
+        return summary
+
+
+    async def _generate(self, contents):
+        if not self.client:
+            # The genai SDK is heavy, so it's only loaded once something actually needs summarizing
+            from google import genai
+            self.client = genai.Client(api_key=self.api_key)
+
+        async with self.semaphore:
+            with METRICS.timer('external_call_seconds', service='gemini'):
+                response = await self.client.aio.models.generate_content(model=SUMMARY_MODEL, contents=contents)
+        return response.text
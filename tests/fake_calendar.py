@@ -0,0 +1,126 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def make_event(event_id, start, hours=1, **fields):
+    '''
+    An event the way the Calendar API returns it, starting at start (a datetime) and lasting hours.
+    '''
+    event = {
+        'kind': 'calendar#event',
+        'id': event_id,
+        'status': 'confirmed',
+        'summary': f'Event {event_id}',
+        'updated': datetime.now(timezone.utc).isoformat(),
+        'start': {'dateTime': start.isoformat()},
+        'end': {'dateTime': (start + timedelta(hours=hours)).isoformat()},
+    }
+    event.update(fields)
+    return event
+
+
+def make_all_day_event(event_id, day, **fields):
+    event = make_event(event_id, datetime.now(timezone.utc), **fields)
+    event['start'] = {'date': day.isoformat()}
+    event['end'] = {'date': (day + timedelta(days=1)).isoformat()}
+    return event
+
+
+def _event_end(event):
+    end = event['end']
+    if 'dateTime' in end:
+        return datetime.fromisoformat(end['dateTime'])
+    return datetime.fromisoformat(end['date'] + 'T00:00:00+00:00')
+
+
+class FakeRequest():
+    def __init__(self, service, params):
+        self.service = service
+        self.params = params
+
+
+    def execute(self):
+        return self.service.run(self.params)
+
+
+class FakeCalendarService():
+    '''
+    A local stand-in for the service object build('calendar', 'v3', ...) returns, covering just events().list().
+
+    Every change made through add(), update() and cancel() moves the calendar to a new version, and a sync
+    token is just a version. Listing with a sync token returns everything changed since (cancelled events
+    included), and listing without one returns the current events that haven't ended by timeMin. Results are
+    split into pages of page_size. Once expire_sync_tokens() is called, any older token gets a 410 Gone.
+    '''
+    def __init__(self, page_size=100):
+        self.page_size = page_size
+        # calendar_id --> [(version, event)], oldest first
+        self.changes = {}
+        self.version = 0
+        self.oldest_valid_version = 0
+        # The parameters of every list() call that was executed
+        self.requests = []
+
+
+    def events(self):
+        return self
+
+
+    def list(self, **params):
+        return FakeRequest(self, params)
+
+
+    def add(self, calendar_id, event):
+        self.version += 1
+        self.changes.setdefault(calendar_id, []).append((self.version, dict(event)))
+
+
+    def update(self, calendar_id, event):
+        self.add(calendar_id, event)
+
+
+    def cancel(self, calendar_id, event_id):
+        self.add(calendar_id, {'kind': 'calendar#event', 'id': event_id, 'status': 'cancelled'})
+
+
+    def expire_sync_tokens(self):
+        self.oldest_valid_version = self.version
+
+
+    def current_events(self, calendar_id):
+        events = {}
+        for _, event in self.changes.get(calendar_id, []):
+            if event['status'] == 'cancelled':
+                events.pop(event['id'], None)
+            else:
+                events[event['id']] = event
+        return events
+
+
+    def run(self, params):
+        self.requests.append(params)
+        calendar_id = params['calendarId']
+        sync_token = params.get('syncToken')
+        if sync_token:
+            since = int(sync_token)
+            if since < self.oldest_valid_version:
+                raise HttpError(httplib2.Response({'status': 410}), json.dumps({'error': {'code': 410, 'message': 'Sync token is no longer valid.'}}).encode('utf-8'))
+            latest = {}
+            for version, event in self.changes.get(calendar_id, []):
+                if version > since:
+                    latest[event['id']] = event
+            items = list(latest.values())
+        else:
+            time_min = datetime.fromisoformat(params['timeMin'])
+            items = [event for event in self.current_events(calendar_id).values() if _event_end(event) > time_min]
+
+        page = int(params.get('pageToken') or 0)
+        result = {'kind': 'calendar#events', 'items': [json.loads(json.dumps(_)) for _ in items[page:page + self.page_size]]}
+        if page + self.page_size < len(items):
+            result['nextPageToken'] = str(page + self.page_size)
+        else:
+            result['nextSyncToken'] = str(self.version)
+        return result
@@ -0,0 +1,127 @@
+import asyncio
+
+# What the fake login server expects, and what it hands out
+USERNAME = 'scribeaccount'
+PASSWORD = 'hunter2'
+CHARACTER = 'Scribby'
+CHARACTER_TOKEN = 'W_SCRIBEACCOUNT_000'
+HASH_KEY = b'abcdefghijklmnopqrstuvwxyzabcdef'
+LOGIN_KEY = 'deadbeef00'
+GAME_KEY = 'cafe1234'
+
+
+def decode_password(key, encoded):
+    # Undoes the scrambling the client does to the password in the A command
+    password = bytearray()
+    for k, c in zip(key, encoded):
+        c = c & 0x7f if c & 0x80 and (c & 0x7f) < ord(b' ') else c
+        c = c ^ 0x40 if k >= ord(b'a') else c
+        password.append(c ^ k)
+    return bytes(password)
+
+
+class FakeEAccessServer():
+    '''
+    A local stand-in for the EAccess login server. Speaks just enough of K/A/G/C/L to log in one character,
+    and points the client at the game server it's given.
+    '''
+    def __init__(self, game_host, game_port, characters=None):
+        self.game_host = game_host
+        self.game_port = game_port
+        self.characters = characters if characters is not None else {CHARACTER_TOKEN: CHARACTER}
+        # Every command received, in order, split on tabs
+        self.received = []
+        self.server = None
+
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = line.rstrip(b'\n').split(b'\t')
+                self.received.append(fields)
+                writer.write(self.reply(fields) + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+    def reply(self, fields):
+        command = fields[0]
+        if command == b'K':
+            return HASH_KEY
+        if command == b'A':
+            if fields[1].decode('ascii') != USERNAME or decode_password(HASH_KEY, fields[2]) != PASSWORD.encode('ascii'):
+                return b'A\t\tPASSWORD'
+            return f'A\t{USERNAME.upper()}\tKEY\t{LOGIN_KEY}\tScribe Account'.encode('ascii')
+        if command == b'G':
+            return b'G\tDragonRealms\tNORMAL\t0\t\tROOT=sgc/dr\tMKTG=info/default.jsp\tMAIN=/dr/'
+        if command == b'C':
+            listing = ''.join(f'\t{token}\t{name}' for token, name in self.characters.items())
+            return f'C\t{len(self.characters)}\t{len(self.characters)}\t0\t0{listing}'.encode('ascii')
+        if command == b'L':
+            return (f'L\tOK\tUPPORT=5535\tGAME=STORM\tGAMECODE=DR\tGAMEHOST={self.game_host}\tGAMEPORT={self.game_port}'
+                f'\tKEY={GAME_KEY}').encode('ascii')
+        return b'?'
+
+
+class FakeGameServer():
+    '''
+    A local stand-in for the game. Once a client sends its key, the greeting is sent (telnet negotiation and all),
+    and then whatever is queued up for each command the client sends. Exiting hangs up.
+    '''
+    def __init__(self, greeting=b'', replies=None, hang_up_after_greeting=False):
+        self.greeting = greeting
+        # command --> bytes sent back when it's received
+        self.replies = replies or {}
+        self.hang_up_after_greeting = hang_up_after_greeting
+        self.key = None
+        # Every command received after the key, in order
+        self.received = []
+        self.server = None
+
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+    async def handle(self, reader, writer):
+        try:
+            self.key = (await reader.readline()).strip().decode('ascii')
+            writer.write(self.greeting)
+            await writer.drain()
+            if self.hang_up_after_greeting:
+                return
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.strip().decode('ascii')
+                if not command:
+                    continue
+                self.received.append(command)
+                writer.write(self.replies.get(command, b''))
+                await writer.drain()
+                if command == 'exit':
+                    break
+        finally:
+            writer.close()
@@ -0,0 +1,99 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from commands import CommandRegistry
+from ratelimit import RateLimiter
+
+LIMITS = {
+    'default': {'per_minute': 0},
+    'commands': {
+        'summarize': {'concurrency': 1},
+        'petpic upload': {'per_minute': 60, 'burst': 1, 'concurrency': 1},
+    },
+}
+
+
+class FakeChannel():
+    def __init__(self):
+        self.sent = []
+
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+def make_message(content, user_id=1):
+    return SimpleNamespace(content=content, author=SimpleNamespace(id=user_id), channel=FakeChannel())
+
+
+class SubcommandLimitTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.registry = CommandRegistry(RateLimiter(LIMITS))
+        self.release = asyncio.Event()
+        self.ran = []
+        self.registry.register('petpic', self.petpic, r'(add|upload|list|random)(?: (.+))?', subcommand_aliases={'add': 'upload'})
+        self.registry.register('summarize', self.summarize)
+
+
+    async def petpic(self, message, cmd, album_name):
+        self.ran.append(cmd)
+        if cmd in ('add', 'upload'):
+            await self.release.wait()
+
+
+    async def summarize(self, message):
+        self.ran.append('summarize')
+        await self.release.wait()
+
+
+    def test_limit_name(self):
+        limiter = self.registry.limiter
+        self.assertEqual(limiter.limit_name('petpic', 'upload'), 'petpic upload')
+        self.assertEqual(limiter.limit_name('petpic', 'list'), 'petpic')
+        self.assertEqual(limiter.limit_name('summarize'), 'summarize')
+
+
+    async def test_light_subcommands_skip_the_heavy_ones_slot(self):
+        upload = asyncio.create_task(self.registry.dispatch(make_message('!petpic upload rex')))
+        await asyncio.sleep(0)
+
+        # The upload is holding the only slot, but listing and random pictures don't need it
+        await asyncio.wait_for(self.registry.dispatch(make_message('!petpic list', user_id=2)), 1)
+        await asyncio.wait_for(self.registry.dispatch(make_message('!petpic random rex', user_id=2)), 1)
+
+        # Another upload, under either name, waits its turn
+        add = asyncio.create_task(self.registry.dispatch(make_message('!petpic add rex', user_id=2)))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.ran, ['upload', 'list', 'random'])
+
+        self.release.set()
+        await asyncio.wait_for(asyncio.gather(upload, add), 1)
+        self.assertEqual(self.ran, ['upload', 'list', 'random', 'add'])
+
+
+    async def test_subcommand_rate_limit(self):
+        self.release.set()
+        await self.registry.dispatch(make_message('!petpic upload rex'))
+
+        # The upload bucket is empty now, under both names, but the rest of petpic isn't limited
+        message = make_message('!petpic add rex')
+        await self.registry.dispatch(message)
+        await self.registry.dispatch(make_message('!petpic list'))
+        self.assertEqual(self.ran, ['upload', 'list'])
+        self.assertEqual(len(message.channel.sent), 1)
+
+
+    async def test_commands_without_subcommands(self):
+        first = asyncio.create_task(self.registry.dispatch(make_message('!summarize')))
+        second = asyncio.create_task(self.registry.dispatch(make_message('!summarize', user_id=2)))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.ran, ['summarize'])
+
+        self.release.set()
+        await asyncio.wait_for(asyncio.gather(first, second), 1)
+        self.assertEqual(self.ran, ['summarize', 'summarize'])
+
+
+if __name__ == '__main__':
+    unittest.main()
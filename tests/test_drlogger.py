@@ -0,0 +1,166 @@
+import os
+import gzip
+import socket
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+
+import drlogger
+from logcleaner import LiveLogCleaner
+
+import fake_dr
+
+# Telnet negotiation (IAC DO TTYPE, IAC WILL ECHO, IAC GA) mixed into the game's output, the way the real one does
+GREETING = (b'\xff\xfd\x18\xff\xfb\x01Welcome to DragonRealms!\r\n'
+    b'>Bob says, "Let us begin."\xff\xf9\r\n'
+    b'Bob nods.\r\n')
+INHALE_REPLY = (b'>Ann waves.\r\n'
+    b'Ann says, "Hello there!"\r\n'
+    b'Ann says, "Shall we?"\r\n'
+    b'Bob sighs.\r\n')
+
+
+class FakeChannel():
+    def __init__(self):
+        self.sent = []
+
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class FakeSummarizer():
+    def __init__(self):
+        self.logs = []
+
+
+    async def summarize_log(self, text):
+        self.logs.append(text)
+        return 'A summary.'
+
+
+class DRLoggerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.game = fake_dr.FakeGameServer(GREETING, {'inhale': INHALE_REPLY})
+        game_port = await self.game.start()
+        self.eaccess = fake_dr.FakeEAccessServer('127.0.0.1', game_port)
+        eaccess_port = await self.eaccess.start()
+
+        self.summarizer = FakeSummarizer()
+        credentials = {'username': fake_dr.USERNAME, 'password': fake_dr.PASSWORD, 'character': fake_dr.CHARACTER.lower()}
+        self.manager = drlogger.DRLoggerManager(None, credentials, [1], 2, 'test', self.summarizer,
+            os.path.join(self.temp_dir.name, 'archive'), 1024 * 1024, eaccess_host='127.0.0.1', eaccess_port=eaccess_port)
+
+
+    async def asyncTearDown(self):
+        await self.manager.kill()
+        await self.eaccess.close()
+        await self.game.close()
+        self.temp_dir.cleanup()
+
+
+    async def wait_for_commands(self, command, count):
+        async def wait():
+            while self.game.received.count(command) < count:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(wait(), 5)
+
+
+    async def test_authenticate(self):
+        key, host, port = await self.manager.authenticate(fake_dr.USERNAME, fake_dr.PASSWORD, fake_dr.CHARACTER)
+
+        self.assertEqual(key, fake_dr.GAME_KEY)
+        self.assertEqual(host, '127.0.0.1')
+        self.assertEqual(port, self.eaccess.game_port)
+        self.assertEqual([fields[0] for fields in self.eaccess.received], [b'K', b'A', b'G', b'C', b'L'])
+        # The fake only answers the A command with a key if the password was scrambled correctly
+        self.assertEqual(self.eaccess.received[2], [b'G', b'DR'])
+        self.assertEqual(self.eaccess.received[4], [b'L', fake_dr.CHARACTER_TOKEN.encode('ascii'), b'PLAY'])
+
+
+    async def test_authenticate_unknown_character(self):
+        login = await self.manager.authenticate(fake_dr.USERNAME, fake_dr.PASSWORD, 'Nobody')
+
+        self.assertIsNone(login)
+        self.assertNotIn(b'L', [fields[0] for fields in self.eaccess.received])
+
+
+    async def test_connect_and_run_until_stopped(self):
+        login = await self.manager.authenticate(fake_dr.USERNAME, fake_dr.PASSWORD, fake_dr.CHARACTER)
+        raw_path = os.path.join(self.temp_dir.name, 'test.raw.gz')
+        cleaned_path = os.path.join(self.temp_dir.name, 'test.txt')
+
+        with mock.patch.object(drlogger, 'KEEPALIVE_INTERVAL', 0.05), LiveLogCleaner(cleaned_path) as cleaner:
+            task = asyncio.create_task(self.manager.connect_and_run(login, raw_path, cleaner))
+            await self.wait_for_commands('scrib', 2)
+            self.assertTrue(self.manager.running)
+            await self.manager.stop(FakeChannel())
+            await asyncio.wait_for(task, 5)
+
+        self.assertEqual(self.game.key, fake_dr.GAME_KEY)
+        self.assertEqual(self.game.received[0], 'inhale')
+        self.assertEqual(self.game.received[-3:], ['nod', 'wave', 'exit'])
+        self.assertEqual(set(self.game.received[1:-3]), {'scrib'})
+        self.assertFalse(self.manager.running)
+        self.assertIsNone(self.manager.writer)
+
+        # Telnet negotiation, prompts and carriage returns are all gone from the raw log
+        with gzip.open(raw_path, 'rt') as f:
+            self.assertEqual(f.read(), 'Welcome to DragonRealms!\nBob says, "Let us begin."\nBob nods.\n'
+                'Ann waves.\nAnn says, "Hello there!"\nAnn says, "Shall we?"\nBob sighs.\n')
+        self.assertEqual(cleaner.lines_read, 7)
+        with open(cleaned_path, newline='') as f:
+            self.assertEqual(f.read(), 'Bob nods.\r\nAnn waves.\r\nAnn says, "Hello there!"\r\nAnn says, "Shall we?"')
+        self.assertEqual(dict(cleaner.speakers), {'Bob': 1, 'Ann': 3})
+
+
+    async def test_connect_and_run_game_hangs_up(self):
+        self.game.hang_up_after_greeting = True
+        login = await self.manager.authenticate(fake_dr.USERNAME, fake_dr.PASSWORD, fake_dr.CHARACTER)
+        cleaned_path = os.path.join(self.temp_dir.name, 'test.txt')
+
+        with LiveLogCleaner(cleaned_path) as cleaner:
+            await asyncio.wait_for(self.manager.connect_and_run(login, os.path.join(self.temp_dir.name, 'test.raw.gz'), cleaner), 5)
+
+        # Nobody is left to say goodbye to
+        self.assertNotIn('exit', self.game.received)
+        self.assertEqual(cleaner.lines_read, 3)
+        self.assertFalse(self.manager.running)
+
+
+    async def test_start_without_any_game_output(self):
+        self.game.greeting = b''
+        self.game.hang_up_after_greeting = True
+        channel = FakeChannel()
+
+        with mock.patch.object(drlogger, 'LOG_TEMP_PATH', self.temp_dir.name):
+            await asyncio.wait_for(self.manager.start(channel), 10)
+
+        self.assertEqual(channel.sent[-1], "😿  💬   Uhoh... Something went wrong, and the scribe didn't wake up...")
+        self.assertEqual(self.summarizer.logs, [])
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+
+    async def test_start_when_the_game_refuses_the_connection(self):
+        # Point the login server at a port nothing is listening on
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.eaccess.game_port = s.getsockname()[1]
+        channel = FakeChannel()
+
+        with mock.patch.object(drlogger, 'LOG_TEMP_PATH', self.temp_dir.name):
+            await asyncio.wait_for(self.manager.start(channel), 10)
+
+        self.assertEqual(channel.sent[-1], "😿  💬   Uhoh... Something went wrong, and the scribe didn't wake up...")
+        # There's no meeting going on, so there's nothing to stop or wait for
+        self.assertFalse(self.manager.running)
+        stop_channel = FakeChannel()
+        await self.manager.stop(stop_channel)
+        self.assertEqual(stop_channel.sent, [])
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
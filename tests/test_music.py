@@ -0,0 +1,202 @@
+import os
+import asyncio
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import music
+from music import MusicManager
+
+TEXT_CHANNEL_ID = 10
+
+
+class FakeDatabase():
+    def __init__(self):
+        self.entries = {}
+
+
+    async def get_audio_cache(self):
+        return [(video_id, filename, num_bytes, 0) for video_id, (filename, num_bytes) in self.entries.items()]
+
+
+    async def add_audio_cache_entry(self, video_id, filename, num_bytes):
+        self.entries[video_id] = (filename, num_bytes)
+
+
+    async def touch_audio_cache_entry(self, video_id):
+        pass
+
+
+    async def delete_audio_cache_entries(self, video_ids):
+        for video_id in video_ids:
+            self.entries.pop(video_id, None)
+
+
+class FakeSource():
+    def __init__(self, path, **kwargs):
+        self.path = path
+
+
+class FakeVoiceClient():
+    '''
+    Plays every song instantly. Disconnecting waits until the test lets it finish.
+    '''
+    def __init__(self, channel, played, disconnecting):
+        self.channel = channel
+        self.guild = channel.guild
+        self.played = played
+        self.disconnecting = disconnecting
+        self.connected = True
+
+
+    def is_connected(self):
+        return self.connected
+
+
+    def play(self, source, after=None):
+        self.played.append(os.path.splitext(os.path.basename(source.path))[0])
+        after(None)
+
+
+    async def disconnect(self):
+        await self.disconnecting.wait()
+        self.connected = False
+
+
+class FakeVoiceChannel():
+    def __init__(self, guild, channel_id, test):
+        self.guild = guild
+        self.id = channel_id
+        self.test = test
+
+
+    async def connect(self):
+        return FakeVoiceClient(self, self.test.played, self.test.disconnecting)
+
+
+class FakeTextChannel():
+    def __init__(self):
+        self.id = TEXT_CHANNEL_ID
+        self.sent = []
+
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class FakeBot():
+    def __init__(self):
+        self.voice_clients = []
+
+
+    async def change_presence(self, **kwargs):
+        pass
+
+
+class MusicPlayerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.played = []
+        self.downloads = []
+        self.disconnecting = asyncio.Event()
+        self.disconnecting.set()
+        self.manager = MusicManager(FakeBot(), FakeDatabase(), [TEXT_CHANNEL_ID], [20], self.temp_dir.name, 1024 * 1024, stream=False)
+        await self.manager.initialize()
+
+        # No network: looking a song up just makes up its info, and downloading one writes a small file
+        async def get_track_info(url):
+            return {'id': music.video_id(url), 'title': music.video_id(url), 'thumbnail': None}
+        def download(url, path):
+            self.downloads.append(music.video_id(url))
+            # Like a postprocessor that didn't leave the file where it was expected
+            if music.video_id(url) == 'x' * 11:
+                return
+            with open(path, 'wb') as f:
+                f.write(b'opus')
+        self.manager.get_track_info = get_track_info
+        self.manager._download = download
+        patcher = mock.patch.object(music.discord, 'FFmpegOpusAudio', FakeSource)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    async def asyncTearDown(self):
+        self.temp_dir.cleanup()
+
+
+    def make_guild(self, guild_id):
+        guild = SimpleNamespace(id=guild_id, name=f'guild {guild_id}')
+        guild.voice_channels = [FakeVoiceChannel(guild, 20, self)]
+        return guild
+
+
+    def make_message(self, guild):
+        async def reply(content):
+            pass
+        return SimpleNamespace(channel=FakeTextChannel(), guild=guild, author=SimpleNamespace(mention='@someone'), reply=reply)
+
+
+    async def play(self, guild, video):
+        message = self.make_message(guild)
+        await self.manager.play(message, f'https://www.youtube.com/watch?v={video * 11}')
+        return message
+
+
+    async def wait_until_done(self, guild):
+        player = self.manager.players[guild.id]
+        async def wait():
+            while player.playing:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(wait(), 5)
+
+
+    async def test_song_queued_while_disconnecting(self):
+        guild = self.make_guild(1)
+        self.disconnecting.clear()
+        await self.play(guild, 'a')
+        player = self.manager.players[guild.id]
+        async def wait():
+            while not self.played:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(wait(), 5)
+        await asyncio.sleep(0.05)
+
+        # The queue is empty and the player is on its way out, when another song comes in
+        self.assertFalse(player.queue)
+        message = await self.play(guild, 'b')
+        self.assertEqual(message.channel.sent, ['Song added to the queue.'])
+        self.disconnecting.set()
+        await self.wait_until_done(guild)
+
+        self.assertEqual(self.played, ['a' * 11, 'b' * 11])
+        self.assertFalse(player.queue)
+
+
+    async def test_same_song_in_two_servers_is_downloaded_once(self):
+        first = self.make_guild(1)
+        second = self.make_guild(2)
+        await self.play(first, 'a')
+        await self.play(second, 'a')
+        await self.wait_until_done(first)
+        await self.wait_until_done(second)
+
+        self.assertEqual(self.downloads, ['a' * 11])
+        self.assertEqual(self.played, ['a' * 11, 'a' * 11])
+        self.assertEqual(self.manager.downloads, {})
+
+
+    async def test_song_that_fails_to_cache_is_skipped(self):
+        guild = self.make_guild(1)
+        message = await self.play(guild, 'x')
+        await self.play(guild, 'a')
+        await self.wait_until_done(guild)
+
+        # Only the broken song is skipped, the rest of the queue still plays
+        self.assertEqual(message.channel.sent, [f"😿  I couldn't play *{'x' * 11}*, skipping it."])
+        self.assertEqual(self.played, ['a' * 11])
+        self.assertNotIn('x' * 11, self.manager.cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
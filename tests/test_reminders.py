@@ -0,0 +1,238 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import reminders
+from reminders import ReminderManager
+
+from fake_calendar import FakeCalendarService, make_event, make_all_day_event
+
+CALENDAR_ID = 'troupe@group.calendar.google.com'
+
+
+class FakeDatabase():
+    '''
+    Keeps the calendar store the way DatabaseManager would, and remembers every update it was given.
+    '''
+    def __init__(self, sync_token=None, events=None):
+        self.sync_token = sync_token
+        self.events = dict(events or {})
+        self.updates = []
+
+
+    async def get_calendar_store(self, calendar_id):
+        return self.sync_token, dict(self.events)
+
+
+    async def update_calendar_store(self, calendar_id, sync_token, upserts=(), deletes=(), replace=False):
+        self.updates.append({'sync_token': sync_token, 'upserts': [_['id'] for _ in upserts], 'deletes': list(deletes), 'replace': replace})
+        if replace:
+            self.events = {}
+        for event_id in deletes:
+            self.events.pop(event_id, None)
+        for event in upserts:
+            self.events[event['id']] = event
+        self.sync_token = sync_token
+        return True
+
+
+    async def get_sent_reminders(self):
+        return {}
+
+
+    async def prune_sent_reminders(self, now):
+        pass
+
+
+class CalendarSyncTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.service = FakeCalendarService(page_size=2)
+        self.db = FakeDatabase()
+        self.manager = ReminderManager(None, self.db, None, {})
+        # Skip building a real service from credentials
+        self.manager.service = self.service
+
+
+    async def asyncTearDown(self):
+        self.manager.executor.shutdown()
+
+
+    def add_events(self, *events):
+        for event in events:
+            self.service.add(CALENDAR_ID, event)
+
+
+    def store(self):
+        return self.manager.event_stores[CALENDAR_ID]
+
+
+    async def test_full_sync(self):
+        self.add_events(
+            make_event('rehearsal', self.now + timedelta(days=1)),
+            make_event('show', self.now + timedelta(days=3)),
+            make_event('cast_party', self.now + timedelta(days=4)),
+            make_all_day_event('festival', (self.now + timedelta(days=7)).date()),
+            make_event('old_show', self.now - timedelta(days=5)))
+
+        await self.manager.sync_calendar(CALENDAR_ID)
+
+        self.assertEqual(set(self.store()), {'rehearsal', 'show', 'cast_party', 'festival'})
+        # Dates are turned into midnight datetimes on the way in
+        self.assertEqual(self.store()['festival']['start'], {'dateTime': (self.now + timedelta(days=7)).date().isoformat() + 'T00:00:00-00:00'})
+        # Four events over pages of two, all with the same lookback and no sync token
+        self.assertEqual(len(self.service.requests), 2)
+        for params in self.service.requests:
+            self.assertNotIn('syncToken', params)
+            self.assertLess(datetime.fromisoformat(params['timeMin']), self.now - reminders.CALENDAR_SYNC_LOOKBACK + timedelta(minutes=1))
+        self.assertEqual(self.service.requests[1]['pageToken'], '2')
+
+        self.assertEqual(self.manager.sync_tokens[CALENDAR_ID], str(self.service.version))
+        self.assertEqual(self.db.updates, [{'sync_token': str(self.service.version),
+            'upserts': ['rehearsal', 'show', 'cast_party', 'festival'], 'deletes': [], 'replace': True}])
+        self.assertEqual(set(self.db.events), set(self.store()))
+
+
+    async def test_incremental_sync(self):
+        self.add_events(
+            make_event('rehearsal', self.now + timedelta(days=1)),
+            make_event('show', self.now + timedelta(days=3)),
+            make_event('cast_party', self.now + timedelta(days=4)))
+        await self.manager.sync_calendar(CALENDAR_ID)
+        first_token = self.manager.sync_tokens[CALENDAR_ID]
+        self.service.requests.clear()
+
+        self.service.update(CALENDAR_ID, make_event('show', self.now + timedelta(days=3, hours=2), summary='The show, moved'))
+        self.service.cancel(CALENDAR_ID, 'cast_party')
+        self.service.cancel(CALENDAR_ID, 'never_seen')
+        self.service.add(CALENDAR_ID, make_event('encore', self.now + timedelta(days=5)))
+        await self.manager.sync_calendar(CALENDAR_ID)
+
+        self.assertEqual([_['syncToken'] for _ in self.service.requests], [first_token, first_token])
+        self.assertEqual(set(self.store()), {'rehearsal', 'show', 'encore'})
+        self.assertEqual(self.store()['show']['summary'], 'The show, moved')
+        # Cancelling something that was never stored isn't a delete
+        self.assertEqual(self.db.updates[-1], {'sync_token': str(self.service.version),
+            'upserts': ['show', 'encore'], 'deletes': ['cast_party'], 'replace': False})
+        self.assertEqual(set(self.db.events), set(self.store()))
+
+        # Nothing changed, so the next sync is one tiny request
+        self.service.requests.clear()
+        await self.manager.sync_calendar(CALENDAR_ID)
+        self.assertEqual(len(self.service.requests), 1)
+        self.assertEqual(self.db.updates[-1]['upserts'], [])
+        self.assertEqual(self.db.updates[-1]['deletes'], [])
+
+
+    async def test_sync_token_expired(self):
+        self.add_events(
+            make_event('rehearsal', self.now + timedelta(days=1)),
+            make_event('show', self.now + timedelta(days=3)))
+        await self.manager.sync_calendar(CALENDAR_ID)
+        stale_token = self.manager.sync_tokens[CALENDAR_ID]
+        self.service.requests.clear()
+
+        self.service.cancel(CALENDAR_ID, 'rehearsal')
+        self.service.add(CALENDAR_ID, make_event('encore', self.now + timedelta(days=5)))
+        self.service.expire_sync_tokens()
+        await self.manager.sync_calendar(CALENDAR_ID)
+
+        # The stale token gets a 410, and everything is fetched again from scratch
+        self.assertEqual(self.service.requests[0]['syncToken'], stale_token)
+        self.assertNotIn('syncToken', self.service.requests[1])
+        self.assertEqual(set(self.store()), {'show', 'encore'})
+        self.assertEqual(self.manager.sync_tokens[CALENDAR_ID], str(self.service.version))
+        self.assertEqual(self.db.updates[-1], {'sync_token': str(self.service.version),
+            'upserts': ['show', 'encore'], 'deletes': [], 'replace': True})
+        self.assertEqual(set(self.db.events), {'show', 'encore'})
+
+
+    async def test_other_errors_keep_the_store(self):
+        self.add_events(make_event('show', self.now + timedelta(days=3)))
+        await self.manager.sync_calendar(CALENDAR_ID)
+        token = self.manager.sync_tokens[CALENDAR_ID]
+
+        def fail(params):
+            raise HttpError(httplib2.Response({'status': 500}), b'{}')
+        self.service.run = fail
+
+        with self.assertRaises(HttpError):
+            await self.manager.sync_calendar(CALENDAR_ID)
+        self.assertEqual(self.manager.sync_tokens[CALENDAR_ID], token)
+        self.assertEqual(set(self.store()), {'show'})
+        self.assertEqual(len(self.db.updates), 1)
+
+
+    async def test_startup_resumes_from_db_and_prunes(self):
+        self.add_events(
+            make_event('old_show', self.now - timedelta(days=3)),
+            make_event('show', self.now + timedelta(days=3)))
+        saved = self.service.current_events(CALENDAR_ID)
+        self.db.sync_token = str(self.service.version)
+        self.db.events = saved
+
+        await self.manager.sync_calendar(CALENDAR_ID)
+
+        # Picks up where the DB left off, rather than listing everything again
+        self.assertEqual([_['syncToken'] for _ in self.service.requests], [str(self.service.version)])
+        # ...and anything over and done with is dropped, locally and in the DB
+        self.assertEqual(set(self.store()), {'show'})
+        self.assertEqual(self.db.updates[-1]['deletes'], ['old_show'])
+        self.assertFalse(self.db.updates[-1]['replace'])
+        self.assertEqual(set(self.db.events), {'show'})
+
+        # An event that just ended is still within the lookback, and stays
+        self.service.add(CALENDAR_ID, make_event('rehearsal', self.now - timedelta(hours=3)))
+        await self.manager.sync_calendar(CALENDAR_ID)
+        self.assertEqual(set(self.store()), {'show', 'rehearsal'})
+
+
+class SharedCalendarTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.service = FakeCalendarService()
+        self.service.add(CALENDAR_ID, make_event('show', self.now + timedelta(minutes=20)))
+        self.channels = [SimpleNamespace(id=1), SimpleNamespace(id=2)]
+        bot = SimpleNamespace(get_all_channels=lambda: self.channels)
+        # Two labels for the same calendar, reminding different channels at different times
+        relay_map = {
+            'troupe': {'calendar_id': CALENDAR_ID, 'channels': [1], 'when': [30, 15], 'ping': False},
+            'speakers': {'calendar_id': CALENDAR_ID, 'channels': [2], 'when': [19], 'ping': True},
+        }
+        self.manager = ReminderManager(bot, FakeDatabase(), None, relay_map)
+        self.manager.service = self.service
+
+
+    async def asyncTearDown(self):
+        for task in self.manager.tasks:
+            task.cancel()
+        await asyncio.wait(self.manager.tasks, timeout=1)
+        self.manager.executor.shutdown()
+
+
+    async def test_one_sync_plans_every_label(self):
+        await self.manager.initialize()
+        async def wait():
+            while len({_.calendar_label for _ in self.manager.triggers}) < 2:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(wait(), 5)
+
+        # One watcher for the calendar, so one sync, planning reminders for both labels
+        self.assertEqual(len(self.manager.tasks), 2)
+        self.assertEqual(len(self.service.requests), 1)
+        planned = sorted((_.calendar_label, _.look_ahead, _.channel.id) for _ in self.manager.triggers)
+        self.assertEqual(planned, [('speakers', 19, 2), ('troupe', 15, 1)])
+
+        # Re-planning one label leaves the other's reminders alone
+        events = self.manager.events_in_range(CALENDAR_ID, self.now, self.now + timedelta(hours=2))
+        self.manager.plan('troupe', CALENDAR_ID, events, [self.channels[0]], [18], False)
+        planned = sorted((_.calendar_label, _.look_ahead, _.channel.id) for _ in self.manager.triggers)
+        self.assertEqual(planned, [('speakers', 19, 2), ('troupe', 18, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,30 @@
 import json
+import time
 import asyncio
 import logging
 
 import requests
 import discord
 
+from metrics import METRICS
+
 TWEET_LOOKBACK = 5
 TWITTER_API_RECENT_ENDPOINT = 'https://api.twitter.com/2/tweets/search/recent?'
 
+# The recent search endpoint only reaches back 7 days, so cached tweets older than that can never be seen again.
+# Keep a little extra as slack, and never allow less than the search window.
+TWITTER_SEARCH_WINDOW_DAYS = 7
+DEFAULT_TWEET_RETENTION_DAYS = 14
+# How often the retention job runs (seconds), how many rows it deletes per batch,
+# and how many runs between incremental vacuums.
+TWEET_RETENTION_INTERVAL = 60 * 60
+TWEET_RETENTION_BATCH_SIZE = 500
+TWEET_RETENTION_VACUUM_EVERY = 24
+TWEET_RETENTION_VACUUM_PAGES = 1000
+
 
 class TweetManager():
-    def __init__(self, bot, db, bearer_token, relay_map):
+    def __init__(self, bot, db, bearer_token, relay_map, retention_days=DEFAULT_TWEET_RETENTION_DAYS):
         self.bot = bot
         self.db = db
         self.bearer_token = bearer_token
@@ -18,13 +32,22 @@ class TweetManager():
         self.relay_map = relay_map
         self.tasks = []
 
+        if retention_days < TWITTER_SEARCH_WINDOW_DAYS:
+            logging.warning(f'Tweet retention of {retention_days} days is shorter than the search window, using {TWITTER_SEARCH_WINDOW_DAYS} days.')
+            retention_days = TWITTER_SEARCH_WINDOW_DAYS
+        self.retention_days = retention_days
+
 
     async def initialize(self):
         logging.info("Initializing tweet watching...")
+        # Resume from the last tweet seen for each account/channel pair, so a restart doesn't re-pull the lookback
+        self.last_seen_tweet_cache = await self.db.get_tweet_cursors()
+        logging.info(f"\tLoaded {len(self.last_seen_tweet_cache)} saved tweet cursors.")
         # For each twitter account, create a new async task that will run polling tweets
         for account in self.relay_map.keys():
             logging.info(f"\tWatching @{account}...")
             self.tasks.append(asyncio.create_task(self.poll_tweets(account)))
+        self.tasks.append(asyncio.create_task(self.prune_tweet_cache()))
 
         for destination_channel_id in self.relay_map[account]:
             channel = discord.utils.get(self.bot.get_all_channels(), id=int(destination_channel_id))
@@ -45,7 +68,8 @@ class TweetManager():
                 params['since_id'] = self.last_seen_tweet_cache[tweet_cache_key]
 
 
-            r = requests.get(TWITTER_API_RECENT_ENDPOINT, params=params, headers=header)
+            with METRICS.timer('external_call_seconds', service='twitter'):
+                r = requests.get(TWITTER_API_RECENT_ENDPOINT, params=params, headers=header)
             content = r.content.decode('utf-8')
             d = json.loads(content)
 
@@ -54,16 +78,18 @@ class TweetManager():
             	for error in d['errors']:
             		if 'since_id' in error['parameters'] and self.last_seen_tweet_cache[tweet_cache_key] in error['parameters']['since_id']:
             			del params['since_id']
-            			self.last_seen_tweet_cache[tweet_cache_key] = None
-            			r = requests.get(TWITTER_API_RECENT_ENDPOINT, params=params, headers=header)
+            			await self._set_cursor(tweet_cache_key, None)
+            			with METRICS.timer('external_call_seconds', service='twitter'):
+            				r = requests.get(TWITTER_API_RECENT_ENDPOINT, params=params, headers=header)
             			content = r.content.decode('utf-8')
             			d = json.loads(content)
             			break
             
             tweets = []
+            newest_id = None
             if d['meta']['result_count'] > 0:
                 tweets = d['data']
-                self.last_seen_tweet_cache[tweet_cache_key] = tweets[0]['id']
+                newest_id = tweets[0]['id']
 
             # On bot startup, look back a certain number of tweets
             if len(tweets) > TWEET_LOOKBACK:
@@ -72,6 +98,8 @@ class TweetManager():
             # Grab the channel
             channel = discord.utils.get(self.bot.get_all_channels(), id=int(destination_channel_id))
             if not channel:
+                if newest_id:
+                    await self._set_cursor(tweet_cache_key, newest_id)
                 return
 
             tweets = tweets[::-1]
@@ -87,14 +115,42 @@ class TweetManager():
                 logging.info(f"New tweet: {tweet['id']} --> {destination_channel_id}")
                 await channel.send(f'https://twitter.com/{account}/status/{tweet["id"]}')
                 await self.db.add_tweet(tweet["id"], destination_channel_id)
+
+            # Only move the saved cursor once everything up to it has been relayed
+            if newest_id:
+                await self._set_cursor(tweet_cache_key, newest_id)
         except Exception as e:
             logging.exception(f'Exception thrown while attempting to poll tweets for channel {destination_channel_id}')
 
 
+    async def _set_cursor(self, tweet_cache_key, since_id):
+        # Write-through, only touching the DB when the cursor actually moves
+        if tweet_cache_key in self.last_seen_tweet_cache and self.last_seen_tweet_cache[tweet_cache_key] == since_id:
+            return
+        self.last_seen_tweet_cache[tweet_cache_key] = since_id
+        await self.db.set_tweet_cursor(tweet_cache_key, since_id)
+
+
     async def poll_tweets(self, account):
         while True:
             # Register the event location for relaying tweets - unique per twitter account and channel)
             for destination_channel_id in self.relay_map[account]:
                 await self.poll_tweets_for_channel(account, destination_channel_id)
             await asyncio.sleep(30)
-        
+
+
+    async def prune_tweet_cache(self):
+        # The tweet cache only exists to dedupe within the search window. Anything older is dead weight.
+        runs = 0
+        while True:
+            try:
+                older_than = int(time.time()) - self.retention_days * 24 * 60 * 60
+                vacuum = runs % TWEET_RETENTION_VACUUM_EVERY == 0
+                removed = await self.db.prune_tweets(older_than, batch_size=TWEET_RETENTION_BATCH_SIZE,
+                    vacuum_pages=TWEET_RETENTION_VACUUM_PAGES if vacuum else 0)
+                if removed:
+                    logging.info(f'Pruned {removed} cached tweets older than {self.retention_days} days.')
+            except Exception as e:
+                logging.exception('Exception thrown while attempting to prune the tweet cache')
+            runs += 1
+            await asyncio.sleep(TWEET_RETENTION_INTERVAL)
@@ -1,22 +1,66 @@
-import re
+import time
+from collections import OrderedDict
 
 
-class ValueRetainingRegexMatcher:
-    '''This is a load of BS to just get around not using PEP 572'''
-    def __init__(self, match_str):
-        self.match_str = match_str
+class LRUCache:
+    '''
+    A small dict-like cache that holds at most max_size entries, evicting the least recently used one.
+    '''
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.entries = OrderedDict()
 
 
-    def match(self, regex):
-        self.retained = re.match(regex, self.match_str)
-        return bool(self.retained)
+    def __contains__(self, key):
+        return self.get(key, self) is not self
 
 
-    def search(self, regex):
-        self.retained = re.search(regex, self.match_str)
-        return bool(self.retained)
+    def __len__(self):
+        return len(self.entries)
 
 
-    def group(self, i):
-        return self.retained.group(i)
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
 
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+
+    def clear(self):
+        self.entries.clear()
+
+
+class TTLCache(LRUCache):
+    '''
+    An LRUCache whose entries also expire ttl seconds after they were put.
+    '''
+    def __init__(self, ttl, max_size=128):
+        super().__init__(max_size=max_size)
+        self.ttl = ttl
+
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self.entries.pop(key, None)
+            return default
+        return value
+
+
+    def put(self, key, value):
+        super().put(key, (time.monotonic() + self.ttl, value))